@@ -5,23 +5,21 @@ from os import getenv, path
 from dotenv import load_dotenv
 load_dotenv()
 
-from typing import Optional, List
+from typing import Optional, Dict
 import sys
 import signal
+import secrets
+from urllib.parse import parse_qs
 
-from cas import CASClient # https://github.com/Chise1/fastapi-cas-example # python_cas ?
-from fastapi import FastAPI, Depends, Request, status, Path
+from fastapi import FastAPI, Request, status, Path
 import uvicorn
-from starlette.middleware.sessions import SessionMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from fastapi_discord import DiscordOAuthClient, RateLimited, Unauthorized # https://github.com/Tert0/fastapi-discord
 #* OR ? :
 #* from starlette_discord.client import DiscordOAuthClient # https://github.com/nwunderly/starlette-discord
-from fastapi_discord import User as DiscordUser
 #from fastapi_discord import Role as DiscordRole #?
-from fastapi_discord import Guild as DiscordGuild
 from fastapi_discord.exceptions import ClientSessionNotInitialized
 from fastapi_discord.models import GuildPreview
 import asyncio
@@ -30,13 +28,22 @@ import logging
 import platform
 from typing import Annotated #TODO: use Annotated
 from time import time
-from httpx import AsyncClient
 from contextlib import asynccontextmanager
 from json import load
 
-from utils import addLoggingLevel
+from utils import addLoggingLevel, precompile_templates, Timer
 #from bot import Bot # TODO: implement bot
 from locales import Locale, DEFAULT_LANG
+from cas_auth import CASAuth, AttributeProjection, CircuitBreaker, CasError, CasRequestError, CasUnavailableError
+from sessions import SessionIndex, SessionRevocationMiddleware, SessionBackend, MemorySessionBackend, SQLiteSessionBackend, ServerSessionMiddleware, CompactSessionMiddleware, regenerate_session_id
+from discord_api import DiscordAPI
+from ratelimit import DiscordRateLimiter
+from token_refresh import DiscordTokenRefresher, DiscordTokenSyncMiddleware
+from guild_index import GuildIndex
+from page_cache import ErrorPages, PageCache
+from fragment_cache import FragmentCacheExtension
+from static_assets import PrecompressedStaticFiles, StaticManifest
+from compression import CompressionMiddleware
 
 # ------------
 
@@ -50,9 +57,25 @@ DEBUG=True if getenv("DEBUG") or getenv("DEBUG") is not None or getenv("DEBUG")
 
 logger = logging.getLogger("app")
 
-templates = Jinja2Templates(directory="src/templates")
+JINJA_CACHE_DIR = getenv('JINJA_CACHE_DIR') # writable directory where compiled templates are kept across restarts, unset to disable
+jinja_bytecode_cache = None
+if JINJA_CACHE_DIR:
+    try:
+        os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+        jinja_bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+    except OSError as e:
+        logger.error(f"Jinja bytecode cache disabled, can't use JINJA_CACHE_DIR={JINJA_CACHE_DIR}: {e}")
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("src/templates"),
+    autoescape=True,
+    bytecode_cache=jinja_bytecode_cache,
+    extensions=[FragmentCacheExtension], # {% cache %} blocks, in templates.env.fragment_cache
+))
 
 #locale: Locale = Locale(debug=DEBUG)
+LOCALE_WATCH_INTERVAL = float(getenv('LOCALE_WATCH_INTERVAL', 2)) # seconds between checks of the locale files for changes, 0 to disable
+PAGE_CACHE = getenv('PAGE_CACHE', "true").lower() != "false" # serve help/about/privacy policy/terms of service rendered once per language
+SITE_URL = str(getenv("SITE_URL", "http://localhost:8000")) if not DEBUG else "http://localhost:8000" # cached and error pages are rendered for it, not the Host header
 
 def init():
     #logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
@@ -85,6 +108,8 @@ def init():
     logger.info("###------------------------")
     logger.info("### Name: "+str(getenv("APP_NAME")))
     logger.info("### Description: "+str(getenv("APP_DESCRIPTION")))
+    compiled, duration, failed = precompile_templates(templates.env) # warm-up, no template compilation on the first requests
+    logger.info(f"### Templates: {compiled} precompiled in {duration:.1f} ms (bytecode cache: {JINJA_CACHE_DIR if jinja_bytecode_cache else 'none'})" + (f", failed: {', '.join(failed)}" if failed else ""))
     logger.info("###------------------------")
 
     try:
@@ -92,6 +117,8 @@ def init():
             app.cas_attr_filter = load(cas_attr_file)
         logger.info("Successfully loaded cas_attributes_filter.json:")
         logger.info(app.cas_attr_filter)
+        app.cas_projection = AttributeProjection(app.cas_attr_filter.keys()) # compiled once, applied on every CAS login
+        cas_client.set_attributes_filter(app.cas_projection.wanted)
     except FileNotFoundError:
         logger.error("config/cas_attributes_filter.json not found, copy the cas_attributes_filter.json.example file, set your filtering CAS attributes and rename it to cas_attributes_filter.json")
         exit(1)
@@ -109,8 +136,20 @@ discord_auth = DiscordOAuthClient(
     scopes=("identify","guilds")#, "guilds", "email") # scopes default: just "identify"
 )
 logger.info(f"discord_auth scopes: {discord_auth.scopes.replace('%20', '_')}")
-DISCORD_TOKEN_URL = "https://discord.com/api/v10/oauth2/token" # ? https://github.com/Tert0/fastapi-discord/issues/96
-#DISCORD_TOKEN_URL = "https://discord.com/api/oauth2/token" # no version in url ?
+# Discord rate limits, shared by the web app and the bot (same outbound IP)
+discord_rate_limiter = DiscordRateLimiter(
+    global_rate=int(getenv('DISCORD_GLOBAL_RATE_LIMIT', 50)), # requests per second, all routes together
+    max_wait=float(getenv('DISCORD_RATE_LIMIT_MAX_WAIT', 5)), # seconds a web request may be delayed before answering 429
+    debug=DEBUG,
+)
+# all Discord OAuth2 and REST calls go through one shared HTTP client (discord_auth only provides the login URL)
+discord_api = DiscordAPI(
+    discord_auth,
+    rate_limiter=discord_rate_limiter,
+    token_cache_ttl=float(getenv('DISCORD_TOKEN_CACHE_TTL', 60)), # seconds a valid Discord token is trusted without asking Discord
+    token_negative_ttl=float(getenv('DISCORD_TOKEN_NEGATIVE_TTL', 3600)), # seconds an invalid/revoked token is remembered
+    debug=DEBUG,
+)
 
 class App(FastAPI):
     #locale: Locale
@@ -118,21 +157,73 @@ class App(FastAPI):
         super().__init__(*args, **kwargs)
         self.locale: Locale = None # extends FastAPI with locale
         self.discord = discord_auth
+        self.discord_api = discord_api
         self.cas_attr_filter = None
+        self.cas_projection: AttributeProjection = None
+        self.session_index: SessionIndex = None
+        self.session_backend: Optional[SessionBackend] = None # None with cookie sessions
+        self.token_refresher: DiscordTokenRefresher = None
+        self.guild_index = GuildIndex() # IDs of the bot's guilds, shared with the bot
+        self.page_cache: Optional[PageCache] = None # None if PAGE_CACHE=false
+        self.error_pages: ErrorPages = None
+        self.compression_stats: Dict[str, Dict[str, int]] = {} # route => bytes before/after CompressionMiddleware
 
 @asynccontextmanager
 async def lifespan(app: FastAPI): # replaces deprecated @app.on_event("startup") and @app.on_event("shutdown")
     # --- startup ---
     logger.info("FastAPI app startup")
     #TODO: create or init database here
-    logger.info("Initializing DiscordClient")
-    await app.discord.init()
+    if getenv("DATABASE_URL"):
+        try:
+            from database import DB
+            app.guild_index.load(await DB.get_all_guild_ids())
+        except Exception as e:
+            logger.error(f"Bot guilds index not loaded from the database (the bot loads it when ready): {e}")
+    logger.info("Initializing Discord API client")
+    await app.discord_api.init()
     logger.info(f"discord_auth scopes: {app.discord.scopes.replace('%20', '_')}")
-    app.locale = Locale(debug=DEBUG)
+    logger.info("Initializing CAS client")
+    await cas_client.init()
+    app.token_refresher.start() # background Discord token refresh
+    app.locale = Locale(debug=DEBUG, watch_interval=LOCALE_WATCH_INTERVAL)
     templates.env.globals.update(lang_str=app.locale.lang_str) # get string from language file
+    app.locale.on_reload(templates.env.fragment_cache.invalidate) # {% cache %} blocks with translated strings
+    if LOCALE_WATCH_INTERVAL > 0:
+        app.locale.start_watching() # reload the locale files when they change, without a restart
+    if PAGE_CACHE:
+        app.page_cache = PageCache(
+            templates, app,
+            base_url=SITE_URL,
+            max_age=int(getenv('PAGE_CACHE_MAX_AGE', 300)), # seconds browsers may reuse a cached page without revalidating it
+            watch_interval=LOCALE_WATCH_INTERVAL,
+            compress=COMPRESSION, # pages compressed once, not per request
+            debug=DEBUG,
+        )
+        app.locale.on_reload(app.page_cache.invalidate)
+        if LOCALE_WATCH_INTERVAL > 0:
+            app.page_cache.start_watching() # cleared when a template changes
+    app.error_pages = ErrorPages(
+        templates, app, app.locale,
+        base_url=SITE_URL,
+        pages=ERROR_PAGES,
+        compress=COMPRESSION, # error pages compressed once, not per request
+        debug=DEBUG,
+    )
+    app.error_pages.render_all() # served as is, no template rendering per error
+    app.locale.on_reload(app.error_pages.render_all)
+    if app.page_cache is not None:
+        app.page_cache.on_template_change(app.error_pages.render_all)
     yield
     # --- shutdown ---
     logger.info("FastAPI app shutdown")
+    await app.locale.stop_watching()
+    if app.page_cache is not None:
+        await app.page_cache.stop_watching()
+    await app.token_refresher.stop()
+    await cas_client.close()
+    await app.discord_api.close()
+    if app.session_backend is not None:
+        await app.session_backend.close()
 
 # FastAPI App
 #app = FastAPI(
@@ -145,29 +236,81 @@ app = App(
     redoc_url=None,
     lifespan=lifespan
 )
-app.mount("/static", StaticFiles(directory="src/static"), name="static")
+STATIC_BUILD_DIR = getenv('STATIC_BUILD_DIR', "build/static") # output of `python src/static_assets.py`, src/static is served as is if it wasn't built
+static_manifest = StaticManifest.load(STATIC_BUILD_DIR)
+app.mount("/static", PrecompressedStaticFiles(
+    directory=STATIC_BUILD_DIR if static_manifest.directory else "src/static",
+    manifest=static_manifest,
+    max_age=int(getenv('STATIC_MAX_AGE', 3600)), # seconds browsers may reuse the static files linked by name (hashed names are immutable)
+), name="static")
 
 # CAS Client
-cas_client = CASClient(
+CAS_VALIDATE_PATH = getenv('CAS_VALIDATE_PATH') # default depends on CAS_VERSION: "/validate", "/serviceValidate" or "/p3/serviceValidate"
+cas_client = CASAuth(
     version=getenv('CAS_VERSION', 1),
     #service_url=getenv('CAS_SERVICE_URL', "http://localhost:8000/login"),
     service_url=(str(getenv('SITE_URL', "http://localhost:8000")) if not DEBUG else "http://localhost:8000")+"/login",
     server_url=getenv('CAS_SERVER_URL'),
-    #validate_url=getenv('CAS_VALIDATE_URL', "/serviceValidate"),
+    validate_path=CAS_VALIDATE_PATH,
+    validation_mode=getenv('CAS_VALIDATION_MODE', "single"), # "single" (1 round trip) or "proxy" (legacy, 3 round trips)
+    timeout=float(getenv('CAS_TIMEOUT', 5)), # seconds, per call to the CAS server
+    login_budget=float(getenv('CAS_LOGIN_BUDGET', 10)), # seconds, for all the CAS calls of one login
+    breaker=CircuitBreaker(
+        failure_threshold=int(getenv('CAS_BREAKER_THRESHOLD', 5)), # consecutive failures before refusing CAS logins
+        reset_timeout=float(getenv('CAS_BREAKER_RESET', 30)), # seconds before trying CAS again
+    ),
+    debug=DEBUG,
 )
-CAS_VALIDATE_PATH = getenv('CAS_VALIDATE_PATH', "/serviceValidate") # or "/proxyValidate" ?
 
 # Session Middleware for FastAPI
 APP_SECRET_KEY = getenv('APP_SECRET_KEY')
 if APP_SECRET_KEY is None:
     logger.error("APP_SECRET_KEY not set")
     exit(1)
-app.add_middleware(SessionMiddleware, # https://www.starlette.io/middleware/#sessionmiddleware
-                    secret_key=APP_SECRET_KEY,
-                    max_age=int(getenv('SESSION_MAX_AGE',12*3600)), # 12*1 hour. Session expiry time in seconds. Defaults to 2 weeks. If set to None then the cookie will last as long as the browser session
-                    same_site="strict", # flag prevents the browser from sending session cookie along with cross-site requests, default:"lax" or "strict"
-                    https_only=False, # indicate that Secure flag should be set (can be used with HTTPS only), default:False
-                    )
+SESSION_MAX_AGE = int(getenv('SESSION_MAX_AGE',12*3600))
+# CAS service ticket => session index for CAS Single Logout, checked inside (so added before) the session middleware
+app.session_index = SessionIndex(ttl=SESSION_MAX_AGE)
+# Discord tokens renewed in the background, written back to the sessions (inside the revocation middleware)
+app.token_refresher = DiscordTokenRefresher(
+    discord_api,
+    margin=float(getenv('DISCORD_TOKEN_REFRESH_MARGIN', 3600)), # seconds before expiry when a token gets refreshed
+    interval=float(getenv('DISCORD_TOKEN_REFRESH_INTERVAL', 60)), # seconds between refresh rounds
+    batch_size=int(getenv('DISCORD_TOKEN_REFRESH_BATCH', 10)), # concurrent refresh requests
+    ttl=SESSION_MAX_AGE,
+    debug=DEBUG,
+)
+app.add_middleware(DiscordTokenSyncMiddleware, refresher=app.token_refresher)
+app.add_middleware(SessionRevocationMiddleware, index=app.session_index)
+SESSION_BACKEND = getenv('SESSION_BACKEND', "memory") # "memory", "sqlite" (server-side, the cookie is only an ID) or "cookie" (signed cookie with all the data)
+if SESSION_BACKEND == "cookie":
+    # like Starlette's SessionMiddleware (https://www.starlette.io/middleware/#sessionmiddleware) with a compact msgpack encoding
+    app.add_middleware(CompactSessionMiddleware,
+                        secret_key=APP_SECRET_KEY,
+                        max_age=SESSION_MAX_AGE, # 12*1 hour. Session expiry time in seconds. Defaults to 2 weeks. If set to None then the cookie will last as long as the browser session
+                        same_site="strict", # flag prevents the browser from sending session cookie along with cross-site requests, default:"lax" or "strict"
+                        https_only=False, # indicate that Secure flag should be set (can be used with HTTPS only), default:False
+                        max_bytes=int(getenv('SESSION_COOKIE_MAX_BYTES', 4000)), # hard budget, "discord_guilds" is dropped first beyond it
+                        )
+else:
+    if SESSION_BACKEND == "sqlite":
+        app.session_backend = SQLiteSessionBackend(getenv('SESSION_SQLITE_PATH', "sessions.db"))
+    else:
+        app.session_backend = MemorySessionBackend(maxsize=int(getenv('SESSION_MEMORY_MAX', 100_000)))
+    logger.info(f"Server-side sessions: {type(app.session_backend).__name__}")
+    app.add_middleware(ServerSessionMiddleware,
+                        backend=app.session_backend,
+                        max_age=SESSION_MAX_AGE,
+                        same_site="strict",
+                        https_only=False,
+                        exclude_paths=("/static",), # no session lookup nor cookie for static files
+                        )
+COMPRESSION = getenv('COMPRESSION', "true").lower() != "false" # brotli/gzip compression of the HTML and JSON responses
+if COMPRESSION:
+    app.add_middleware(CompressionMiddleware,
+                        minimum_size=int(getenv('COMPRESSION_MIN_SIZE', 500)), # bytes, smaller responses are sent as is
+                        exclude_paths=("/static",), # precompressed by the static build
+                        stats=app.compression_stats,
+                        )
 
 
 #admin_guild: DiscordGuild = DiscordGuild(
@@ -192,6 +335,7 @@ templates.env.globals.update(env_var=env_var) # or templates.env.filter["env_var
 #templates.env.globals.update(lang_str=app.locale.lang_str) # get string from language file
 templates.env.globals.update(time=time) # get current time
 templates.env.globals.update(is_debug=is_debug) # check if in debug mode
+templates.env.globals.update(static_url=static_manifest.static_url) # URL of a static file, content hashed if built
 
 
 #@app.on_event("startup") #* DEPRECATED
@@ -208,13 +352,32 @@ async def teapot():
 async def hello():
     return HTMLResponse("<h1>Hello, world!</h1>")
 
+LANG_COOKIE = "lang" # last /{lang}/ page visited, a plain cookie: anonymous visitors get no server-side session
+LANG_COOKIE_MAX_AGE = 365*24*3600
+
+def preferred_lang(request: Request) -> str:
+    """
+    Language to redirect to after a login: the `lang` cookie, else the Accept-Language header, else the default
+    """
+    lang = request.cookies.get(LANG_COOKIE)
+    if lang in app.locale.lang_list:
+        return lang
+    return app.locale.negotiate(request.headers.get("Accept-Language")) or DEFAULT_LANG
+
+def remember_lang(request: Request, response: Response, lang: str) -> Response:
+    """
+    Sets the `lang` cookie of `response` to `lang` if it is a supported language the cookie doesn't have yet
+    """
+    if lang in app.locale.lang_list and request.cookies.get(LANG_COOKIE) != lang:
+        response.set_cookie(LANG_COOKIE, lang, max_age=LANG_COOKIE_MAX_AGE, samesite="lax")
+    return response
+
 @app.get('/', response_class=RedirectResponse)
 async def index_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower() # get first language from header
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         if DEBUG:
-            logger.debug(f"index_without_lang: in Accept-Language header: {lang_header} => pref_lang={pref_lang}")
+            logger.debug(f"index_without_lang: in Accept-Language header: {request.headers.get('Accept-Language')} => pref_lang={pref_lang}")
         return RedirectResponse(url=f"/{pref_lang}/")
     return RedirectResponse(url=f"/{DEFAULT_LANG}/", status_code=status.HTTP_308_PERMANENT_REDIRECT)
 
@@ -222,19 +385,17 @@ async def index_without_lang(request: Request):
 async def index(request: Request, lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])]):# lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])]
     if lang in ["favicon.ico"]:
         return
-    request.session['lang'] = lang
     #check if user is already logged in in request.session, redirect to user if so
     user = request.session.get("user")
     if user:
-        return RedirectResponse(url=f"/{lang}/user")
+        return remember_lang(request, RedirectResponse(url=f"/{lang}/user"), lang)
     
-    return templates.TemplateResponse(name="index.jinja", context={"request": request,"hello": "world", "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('home_page_title', lang)})
+    return remember_lang(request, templates.TemplateResponse(name="index.jinja", context={"request": request,"hello": "world", "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('home_page_title', lang)}), lang)
 
 @app.get('/profile')
 async def profile_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower() # get first language from header
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         return RedirectResponse(url=f"/{pref_lang}/user")
     return RedirectResponse(url=f"/{DEFAULT_LANG}/user", status_code=status.HTTP_308_PERMANENT_REDIRECT)
 @app.get('/{lang}/profile')
@@ -242,9 +403,8 @@ async def profile(request: Request, lang: Annotated[str, Path(title="2-letter la
     return RedirectResponse(url=f"/{lang}/user")
 @app.get('/me')
 async def me_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower() # get first language from header
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         return RedirectResponse(url=f"/{pref_lang}/user")
     return RedirectResponse(url=f"/{DEFAULT_LANG}/user", status_code=status.HTTP_308_PERMANENT_REDIRECT)
 @app.get('/{lang}/me')
@@ -254,15 +414,16 @@ async def me(request: Request, lang: Annotated[str, Path(title="2-letter languag
 
 @app.get('/user', response_class=RedirectResponse)
 async def user_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower() # get first language from header
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         return RedirectResponse(url=f"/{pref_lang}/user")
     return RedirectResponse(url=f"/{DEFAULT_LANG}/user", status_code=status.HTTP_308_PERMANENT_REDIRECT)
 
 @app.get('/{lang}/user', response_class=HTMLResponse)
 async def user(request: Request, lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])], debug: Optional[str] = None, discorddebug: Optional[bool] = None): # lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])]
-    request.session['lang'] = lang
+    return remember_lang(request, await user_page(request, lang, debug, discorddebug), lang)
+
+async def user_page(request: Request, lang: str, debug: Optional[str], discorddebug: Optional[bool]) -> Response:
     if DEBUG:
         logger.debug(f"session.user: {request.session.get('user')}")
         if debug == APP_SECRET_KEY:
@@ -272,21 +433,24 @@ async def user(request: Request, lang: Annotated[str, Path(title="2-letter langu
                 logger.debug(f"Debug mode: user_with_discord page accessed with ?discorddebug=true")
                 return templates.TemplateResponse(name="user_with_discord.jinja", context={"request": request,"cas_username": "debug_username", "cas_email": "debug_email@example.org", "discord_id": "000", "discord_username": "@debug_discord_username", "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('user_page_title', lang)})
             return templates.TemplateResponse(name="user.jinja", context={"request": request,"cas_username": "debug_username", "cas_email": "debug_email@example.org", "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('user_page_title', lang)})
-    user = request.session.get("user")
+    user = app.cas_projection.unpack(request.session.get("user"))
+    if user is None and request.session.get("user"): # packed with another CAS attributes filter, log in again
+        request.session.pop("user")
     if DEBUG:
-        logger.debug(f"user: {user}")
+        logger.debug(f"user: {user!r}")
     # ---------------- user was CAS authenticated ----------------
     if user:
         # %%%%%%%%%%%%% user is Discord authenticated %%%%%%%%%%%%%%%%%
-        if await discord_auth.isAuthenticated(request.session['access_token']):#TODO: or await db.user_linked_discord(cas_username=user):
-            return templates.TemplateResponse(name="user_with_discord.jinja", context={"request": request,"cas_username": user, "cas_email": "test","discord_id": request.session['discord_id'], "discord_username": request.session['discord_username'], "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('user_page_title', lang)})
+        discord_token = request.session.get('discord_token')
+        if discord_token and await discord_api.is_authenticated(discord_token):#TODO: or await db.user_linked_discord(cas_username=user):
+            return templates.TemplateResponse(name="user_with_discord.jinja", context={"request": request,"cas_username": user.user, "cas_email": user.get('mail', ""),"discord_id": request.session['discord_id'], "discord_username": request.session['discord_username'], "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('user_page_title', lang)})
         # %%%%%%%%%%%%% user is not Discord authenticated %%%%%%%%%%%%%
         else:
             if DEBUG:
-                cas_user = str(user['user'])
+                cas_user = str(user.user)
                 logout_url = request.url_for('logout')
                 return HTMLResponse(f'Logged in as {cas_user}. <a href="{logout_url}">Logout</a>')
-            return templates.TemplateResponse(name="user.jinja", context={"request": request,"cas_username": user, "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('user_page_title', lang)})
+            return templates.TemplateResponse(name="user.jinja", context={"request": request,"cas_username": user.user, "cas_email": user.get('mail', ""), "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('user_page_title', lang)})
         # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     # ---------------- user is not CAS authenticated ----------------
     elif request.session.get("discord_token"):
@@ -305,10 +469,12 @@ async def login(request: Request, next: Optional[str] = None, ticket: Optional[s
     service_ticket = ticket # ST from user to verify with CAS server
     if request.session.get("user", None):
         # Already logged in
-        return RedirectResponse(request.url_for('user', lang=request.session['lang']))
+        return RedirectResponse(request.url_for('user', lang=preferred_lang(request)))
 
     # next = request.args.get('next')
     # ticket = request.args.get('ticket')
+    if cas_client.breaker.state == "open": # CAS is failing, don't send users (nor their tickets) to it
+        return cas_unavailable_response(request)
     # ---------------- log in to CAS (redirect to CAS server) --------------------
     if not service_ticket: # first login -> redirect to CAS
         # No ticket, the request come from end user, send to CAS login
@@ -325,35 +491,74 @@ async def login(request: Request, next: Optional[str] = None, ticket: Optional[s
         logger.debug(f'next: {next}')
 
     # Send service ticket (ST) to CAS server to verify, get back user details as xml/dict
-    user_from_cas, attributes_from_cas, pgtiou = cas_client.verify_ticket(service_ticket) # pgtIou means Proxy Granting Ticket IOU
-    proxy_ticket = cas_client.get_proxy_ticket(pgtiou) # get Proxy Ticket (PT) for Proxy Callback
-    user_from_cas_proxy, attributes_from_cas_proxy, pgtiou_proxy = cas_client.verify_ticket(proxy_ticket) # verify ticket again to get user details
+    timer = Timer()
+    try:
+        user_from_cas, attributes_from_cas = await cas_client.validate(service_ticket, timer)
+    except (CasUnavailableError, CasRequestError) as e:
+        logger.error(f"login: CAS server unavailable: {e}")
+        return cas_unavailable_response(request)
+    except CasError as e:
+        logger.error(f"login: CAS ticket validation failed: {e}")
+        user_from_cas, attributes_from_cas = None, {}
 
-    # Ony keep attributes that are in the filter (from file cas_attributes_filter.json)
-    filtered_attributes = {key: value for key, value in attributes_from_cas.items() if key in app.cas_attr_filter}
+    # Ony keep attributes that are in the filter (from file cas_attributes_filter.json), normalized
+    cas_user = app.cas_projection.apply(user_from_cas, attributes_from_cas) if user_from_cas else None
 
     if DEBUG:
         logger.debug("Got response from ticket verification")
-        logger.debug(f"proxy_ticket: {proxy_ticket}")
-        logger.debug(f"user_from_cas_proxy, attributes_from_cas_proxy, pgtiou_proxy: {user_from_cas_proxy}, {attributes_from_cas_proxy}, {pgtiou_proxy}")
-        logger.debug(f"CAS verify service_ticket response: user: {user_from_cas}, attributes: {attributes_from_cas}, pgtiou: {pgtiou}")
+        logger.debug(f"CAS verify service_ticket response: user: {user_from_cas}, attributes: {attributes_from_cas}")
         logger.debug(f"attribute.cn (complete name) = {attributes_from_cas.get('cn')}, attribute.mail = {attributes_from_cas.get('mail')}, user = {user_from_cas}, attributes_from_cas.supannRefId = {attributes_from_cas.get('supannRefId')}, attributes_from_cas.supannRoleEntite (group) = {attributes_from_cas.get('supannRoleEntite')}")
         logger.debug(f"attributes_filter: {app.cas_attr_filter}")
-        logger.debug(f"filtered_attributes: {filtered_attributes}")
+        logger.debug(f"cas_user: {cas_user!r}")
 
 
     if not user_from_cas: # Failed to verify service_ticket
         login_url = request.url_for('login')
         if DEBUG:
-            return HTMLResponse(f'Failed to verify ticket. <a href="{login_url}">Login</a>')
-        return RedirectResponse(login_url)
+            return HTMLResponse(f'Failed to verify ticket. <a href="{login_url}">Login</a>', headers={"Server-Timing": timer.header()})
+        return RedirectResponse(login_url, headers={"Server-Timing": timer.header()})
     else:  # Login successfully, redirect according `next` query parameter.? or to /user
         #response = RedirectResponse(next)
-        response = RedirectResponse(request.url_for('user', lang=request.session['lang']))
-        request.session['user'] = dict(user=user_from_cas)
+        response = RedirectResponse(request.url_for('user', lang=preferred_lang(request)), headers={"Server-Timing": timer.header()})
+        request.session['user'] = cas_user.pack()
+        request.session['sid'] = secrets.token_urlsafe(16) # new session ID for each login
+        store_id = regenerate_session_id(request.scope) # new server-side session (store) ID too, None with cookie sessions
+        app.session_index.add(service_ticket, request.session['sid'], store_id)
         return response
 
 
+@app.post('/login')
+async def cas_single_logout(request: Request):
+    """
+    CAS Single Logout (SLO) back-channel: the CAS server POSTs a `logoutRequest` to the service URL
+    when the user logs out of CAS, its session index is the service ticket of the login.
+    """
+    form = parse_qs((await request.body()).decode("utf-8", errors="replace"))
+    logout_request = form.get("logoutRequest")
+    if not logout_request:
+        return HTMLResponse("Missing logoutRequest", status_code=status.HTTP_400_BAD_REQUEST)
+    try:
+        service_ticket = cas_client.parser.parse_logout_request(logout_request[0].encode("utf-8"))
+    except CasError as e:
+        logger.warning(f"cas_single_logout: invalid logoutRequest: {e}")
+        return HTMLResponse("Invalid logoutRequest", status_code=status.HTTP_400_BAD_REQUEST)
+    sid, store_id = app.session_index.logout(service_ticket) if service_ticket else (None, None)
+    app.token_refresher.forget(sid)
+    if store_id is not None and app.session_backend is not None:
+        await app.session_backend.delete(store_id) # server-side session deleted right away
+    if DEBUG:
+        logger.debug(f"cas_single_logout: service_ticket={service_ticket} => session {sid} logged out")
+    return HTMLResponse("OK")
+
+
+def cas_unavailable_response(request: Request) -> HTMLResponse:
+    """
+    Pre-rendered "CAS unavailable" page (503), served instead of queuing logins on a failing CAS server.
+    """
+    retry_after = max(1, round(cas_client.breaker.retry_after()))
+    return app.error_pages.response(request, "cas_unavailable", error_lang(request), status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(retry_after)})
+
+
 @app.get('/logout')
 async def logout(request: Request):
     user = request.session.get("user")
@@ -370,16 +575,25 @@ async def logout(request: Request):
         return RedirectResponse(request.url_for('login'))
 
 
+def forget_discord_session(request: Request):
+    """
+    Removes the Discord tokens and profile from the session, and stops their background refresh
+    """
+    for key in ("discord_token", "discord_refresh_token", "discord_username", "discord_global_name", "discord_id", "discord_guilds", "discord_token_expires_at"):
+        request.session.pop(key, None)
+    app.token_refresher.forget(request.session.get('sid'))
+
 @app.get('/logout-callback')
 def logout_callback(request: Request):
     # redirect from CAS logout request after CAS logout successfully
     # response.delete_cookie('username')
     request.session.pop("user", None)
+    forget_discord_session(request)
     
     #login_url = request.url_for('login')
     #return HTMLResponse(f'Logged out from CAS. <a href="{login_url}">Login</a>')
     
-    return RedirectResponse(request.url_for('index'))
+    return RedirectResponse(request.url_for('index', lang=preferred_lang(request)))
 
 
 @app.get('/discord-login')
@@ -388,7 +602,7 @@ async def discord_login(request: Request):
     if DEBUG or user:
         # check if already logged in with discord, redirect to user if so
         if request.session.get("discord_token"):
-            return RedirectResponse(request.url_for('user',lang=request.session['lang']))
+            return RedirectResponse(request.url_for('user',lang=preferred_lang(request)))
 
         #TODO:
         #user_session_state = generate_random(seed=request.session.items())
@@ -406,36 +620,26 @@ async def discord_login(request: Request):
         return RedirectResponse(request.url_for('login'), status_code=status.HTTP_401_UNAUTHORIZED)
 
 
-#TODO: NOT USE THIS ?
-async def get_user(token: str = Depends(discord_auth.get_token)):
-    if "identify" not in discord_auth.scopes:
-        raise discord_auth.ScopeMissing("identify")
-    route = "/users/@me"
-    return DiscordUser(**(await discord_auth.request(route, token)))
-    #return user
-#TODO: NOT USE THIS ?
-async def get_user_guilds(token: str = Depends(discord_auth.get_token)):
-    if "guilds" not in discord_auth.scopes:
-        raise discord_auth.ScopeMissing("guilds")
-    route = "/users/@me/guilds"
-    return [DiscordGuild(**guild) for guild in await discord_auth.request(route, token)]
-    #return guilds
-
-
 @app.get('/discord-callback')
 async def discord_callback(request: Request, code: str, state: str):
     cas_user = request.session.get("user")
     if DEBUG or cas_user:
         logger.debug(f"discord_callback: code={code}, state={state}")
 
-        token, refresh_token = await discord_auth.get_access_token(code) # ?
+        timer = Timer()
+        with timer("discord-token"):
+            tokens = await discord_api.get_access_token(code) # ?
+        token, refresh_token = tokens.access_token, tokens.refresh_token
         if getenv("DEBUG"):
             logger.debug(f"discord_callback: token={token}, refresh_token={refresh_token}")
         request.session['discord_refresh_token'] = refresh_token
         request.session['discord_token'] = token #await discord_auth.get_token(request=request) #! or just token from above ?
+        request.session['discord_token_expires_at'] = tokens.expires_at
 
-        #TODO: get user info from discord
-        user: DiscordUser = await get_user(token=token)
+        # user and guilds are fetched concurrently (all_user_guilds is None if they can't be fetched)
+        with timer("discord-profile"):
+            user, all_user_guilds = await discord_api.get_user_and_guilds(token, timer)
+        logger.info(f"discord_callback: {timer}")
 
         if DEBUG:
             logger.debug(f"discord_callback: get_user.username: {user.username}")
@@ -445,27 +649,28 @@ async def discord_callback(request: Request, code: str, state: str):
         request.session["discord_id"] = user.id
         # avatar is https://cdn.discordapp.com/avatars/{user.id}/{user.avatar}.png
 
-        try:
-            logger.debug("discord_callback: getting user guilds")
-            #TODO: get user guilds from discord
-            all_user_guilds: List[DiscordGuild] = await get_user_guilds(token=token)
-            if getenv("DEBUG"):
-                logger.debug(f"discord_callback: user_guilds[0]={all_user_guilds[0]}")
-            ###user_guilds: List[DiscordGuild] = await discord_auth.guilds()
-
-            #user_guilds = [x for x in all_user_guilds if x in db.get_all_guilds()] #TODO: check which guilds that the user and the bot are both in, and only put the intersect in the session
-            #request.session["discord_guilds"] = user_guilds
-        except:
-            logger.error(f"ScopeMissing error in Discord API Client: missing \"guilds\" in scopes -> ignoring user guilds")
+        if getenv("DEBUG") and all_user_guilds:
+            logger.debug(f"discord_callback: user_guilds[0]={all_user_guilds[0]}")
+        if all_user_guilds is not None:
+            # only the IDs of the guilds that the user and the bot are both in, unset if the bot's guilds aren't known
+            shared_guilds = app.guild_index.intersect(guild.id for guild in all_user_guilds)
+            if shared_guilds is not None:
+                request.session["discord_guilds"] = shared_guilds
+            else:
+                request.session.pop("discord_guilds", None)
+                logger.warning("discord_callback: bot guilds index not loaded, shared guilds not stored")
 
         try:
             assert state == "my_test_state" # compares state for security # TODO: assert state
         except AssertionError:
+            app.token_refresher.forget(request.session.get('sid'))
             request.session.clear()
             logger.error("discord_callback: state does not match")
             return RedirectResponse(request.url_for('login'), status_code=status.HTTP_406_NOT_ACCEPTABLE)
+        if request.session.get('sid'):
+            app.token_refresher.add(request.session['sid'], tokens) # refreshed in the background before it expires
 
-        return RedirectResponse(request.url_for('user', lang=request.session['lang']))
+        return RedirectResponse(request.url_for('user', lang=preferred_lang(request)), headers={"Server-Timing": timer.header()})
         ##try:
         ##    await discord_auth.callback(request)
         ##    return RedirectResponse(request.url_for('user'))
@@ -485,18 +690,17 @@ async def discord_callback(request: Request, code: str, state: str):
     response_model=bool,
 )
 async def isDiscordAuthenticated(request: Request):
-    try:
-        auth = await discord_auth.isAuthenticated(token=request.session['discord_token'])
-        return auth
-    except Unauthorized:
+    token = request.session.get('discord_token')
+    if not token:
         return False
+    return await discord_api.is_authenticated(token)
 
 
 @app.get('/discord-logout')#, dependencies=[Depends(discord_auth.requires_authorization)])
 async def discord_logout(request: Request):#, token: str = Depends(discord_auth.get_token)):
     try:
         #if await discord_auth.isAuthenticated(token):
-        if await discord_auth.isAuthenticated(request.session['discord_token']):
+        if await discord_api.is_authenticated(request.session['discord_token']):
             if DEBUG:
                 logger.debug("discord_logout: isAuthenticated=True")
     #if await discord_auth.isAuthenticated(request.session['access_token']):
@@ -506,56 +710,49 @@ async def discord_logout(request: Request):#, token: str = Depends(discord_auth.
             #await discord_auth.revoke(request.session['discord_token']) #? not in fastapi-discord ?
             # see https://github.com/treeben77/discord-oauth2.py/blob/main/discordoauth2/__init__.py#L242
             if DEBUG:
-                logger.debug("discord_logout: revoking discord_token")
-            await revoke_discord_token(request.session['discord_token'], "access_token", request.session['discord_username'])
-            if DEBUG:
-                logger.debug("discord_logout: revoking discord_refresh_token")
-            await revoke_discord_token(request.session['discord_refresh_token'], "refresh_token", request.session['discord_username'])
-
-            request.session.pop("discord_token", None)
-            request.session.pop("discord_refresh_token", None)
-            request.session.pop('discord_username', None)
-            request.session.pop("discord_global_name", None)
-            request.session.pop("discord_id", None)
-            request.session.pop("discord_guilds", None)
+                logger.debug("discord_logout: revoking discord_token and discord_refresh_token")
+            timer = Timer()
+            with timer("discord-revoke"):
+                await discord_api.revoke_tokens(request.session['discord_token'], request.session.get('discord_refresh_token'), request.session.get('discord_username'), timer)
+            logger.info(f"discord_logout: {timer}")
+
+            forget_discord_session(request)
         
-        return RedirectResponse(request.url_for('user', lang=request.session['lang']))
+        return RedirectResponse(request.url_for('user', lang=preferred_lang(request)))
     
     except Unauthorized:
         cas_user = request.session.get("user")
         if cas_user:
-            return RedirectResponse(request.url_for('user', lang=request.session['lang']))
+            return RedirectResponse(request.url_for('user', lang=preferred_lang(request)))
         else:
             return RedirectResponse(request.url_for('login'), status_code=status.HTTP_401_UNAUTHORIZED)
     except KeyError:
-        if request.session['lang'] in app.locale.lang_list:
-            return RedirectResponse(url=f"/{request.session['lang']}/user")
-        else:
-            return RedirectResponse(url=f"/{DEFAULT_LANG}/user")
+        return RedirectResponse(url=f"/{preferred_lang(request)}/user")
 
-# FIXME: #! doesn't seem to be working ?
-async def revoke_discord_token(token: str, token_type: str=None, user: str=None):
+METRICS_TOKEN = getenv('METRICS_TOKEN') # bearer token for /metrics/http-pools, disabled if not set (never APP_SECRET_KEY)
+@app.get('/metrics/http-pools', response_class=JSONResponse)
+async def http_pools_metrics(request: Request):
     """
-    Custom discord user token revoke implementation (which is missing from fastapi-discord).
+    Connection reuse of the shared HTTP clients (Discord, CAS) and cache stats,
+    for the `Authorization: Bearer <METRICS_TOKEN>` header only (not found without METRICS_TOKEN)
     """
-    async with AsyncClient(app=app, base_url=DISCORD_TOKEN_URL) as ac:
-        response = await ac.post(
-            "/revoke",
-            data={"token": token, "token_type_hint": token_type},
-            auth=(discord_auth.client_id, discord_auth.client_secret)
-        )
-        
-    if response.status_code == 200:# or response.status_code.OK ?:
-        if DEBUG:
-            logger.debug(f"revoke_discord_token: Discord token (type:{token_type}) revoked successfully for user:{user}.")
-        return True
-    elif response.status_code == 401:
-        logger.error(f"revoke_discord_token: 401 This AccessToken does not have the necessary scope.")
-    elif response.status_code == 429:
-        logger.error(f"revoke_discord_token: 429 You are being Rate Limited. Retry after: {response.json()['retry_after']}")
-    else:
-        logger.error(f"revoke_discord_token: Unexpected HTTP response {response.status_code}")
-    return False
+    if not METRICS_TOKEN:
+        return JSONResponse({"detail": "Not Found"}, status_code=status.HTTP_404_NOT_FOUND)
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        return JSONResponse({"error": "Forbidden"}, status_code=status.HTTP_403_FORBIDDEN)
+    return {
+        "discord": {
+            **discord_api.pool_stats.as_dict(),
+            "token_cache": discord_api.token_cache_stats,
+            "rate_limits": discord_rate_limiter.stats,
+            "token_refresh": {"sessions": len(app.token_refresher), **app.token_refresher.stats},
+        },
+        "cas": cas_client.pool_stats.as_dict(),
+        "page_cache": {"pages": len(app.page_cache), **app.page_cache.stats} if app.page_cache is not None else None,
+        "fragment_cache": {"fragments": len(templates.env.fragment_cache), **templates.env.fragment_cache.stats},
+        "compression": {route: {**stats, "saved": stats["bytes_in"] - stats["bytes_out"]} for route, stats in app.compression_stats.items()},
+    }
 
 #TODO: rate limit
 @app.post('/user/force-add-roles') # POST request
@@ -571,72 +768,90 @@ async def force_add_roles(request: Request):
     for guild in user_guilds:
         await bot.add_roles(guild.discord_guild_id, user_discord_id)
     """
-    if request.session['lang'] in app.locale.lang_list:
-        #return RedirectResponse(url=f"/{request.session['lang']}/user", status_code=status.HTTP_303_SEE_OTHER)
-        return RedirectResponse(request.url_for('user', lang=request.session['lang']), status_code=status.HTTP_303_SEE_OTHER)
-    else:
-        #return RedirectResponse(url=f"/{DEFAULT_LANG}/user", status_code=status.HTTP_303_SEE_OTHER)
-        return RedirectResponse(request.url_for('user', lang=DEFAULT_LANG), status_code=status.HTTP_303_SEE_OTHER)
+    return RedirectResponse(request.url_for('user', lang=preferred_lang(request)), status_code=status.HTTP_303_SEE_OTHER)
 
 # ---- other pages ----
 
+async def content_page(request: Request, name: str, lang: str, page_title: str):
+    """
+    Pages that only depend on the language, from the page cache for the supported languages
+    """
+    context = {"lang_list": app.locale.lang_list, "page_title": page_title}
+    if app.page_cache is not None and lang in app.locale.lang_list:
+        return await app.page_cache.response(request, name, lang, context)
+    return templates.TemplateResponse(name=name, context={"request": request, "current_lang": lang, **context})
+
 @app.get('/help')
 async def help_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower()
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         return RedirectResponse(url=f"/{pref_lang}/help")
         return RedirectResponse(url_for('help', lang=pref_lang))
     return RedirectResponse(url=f"/{DEFAULT_LANG}/help", status_code=status.HTTP_308_PERMANENT_REDIRECT)
     return RedirectResponse(url_for('help', lang=DEFAULT_LANG), status_code=status.HTTP_308_PERMANENT_REDIRECT)
 @app.get('/{lang}/help', response_class=HTMLResponse)
 async def help(request: Request, lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])]):
-    return templates.TemplateResponse(name="help.jinja", context={"request": request, "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('help_page_title', lang)})
+    return await content_page(request, "help.jinja", lang, app.locale.lang_str('help_page_title', lang))
 
 @app.get('/about')
 async def about_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower()
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         return RedirectResponse(url=f"/{pref_lang}/about")
         return RedirectResponse(url_for('about', lang=pref_lang))
     return RedirectResponse(url=f"/{DEFAULT_LANG}/about", status_code=status.HTTP_308_PERMANENT_REDIRECT)
     return RedirectResponse(url_for('about', lang=DEFAULT_LANG), status_code=status.HTTP_308_PERMANENT_REDIRECT)
 @app.get('/{lang}/about', response_class=HTMLResponse)
 async def about(request: Request, lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])]):
-    return templates.TemplateResponse(name="about.jinja", context={"request": request, "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('about_page_title', lang)})
+    return await content_page(request, "about.jinja", lang, app.locale.lang_str('about_page_title', lang))
 
 @app.get('/privacy-policy')
 async def privacy_policy_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower()
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         return RedirectResponse(url=f"/{pref_lang}/privacy-policy")
         return RedirectResponse(url_for('privacy_policy', lang=pref_lang))
     return RedirectResponse(url=f"/{DEFAULT_LANG}/privacy-policy", status_code=status.HTTP_308_PERMANENT_REDIRECT)
     return RedirectResponse(url_for('privacy_policy', lang=DEFAULT_LANG), status_code=status.HTTP_308_PERMANENT_REDIRECT)
 @app.get('/{lang}/privacy-policy', response_class=HTMLResponse)
 async def privacy_policy(request: Request, lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])]):
-    return templates.TemplateResponse(name="privacypolicy.jinja", context={"request": request, "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('privacy_policy', lang)})
+    return await content_page(request, "privacypolicy.jinja", lang, app.locale.lang_str('privacy_policy', lang))
 
 @app.get('/terms-of-service')
 async def terms_of_service_without_lang(request: Request):
-    lang_header = request.headers["Accept-Language"]
-    pref_lang = lang_header.split(',')[0].split(';')[0].strip().split('-')[0].lower()
-    if pref_lang in app.locale.lang_list:
+    pref_lang = app.locale.negotiate(request.headers.get("Accept-Language"))
+    if pref_lang is not None:
         return RedirectResponse(url=f"/{pref_lang}/terms-of-service")
         return RedirectResponse(url_for('terms_of_service', lang=pref_lang))
     return RedirectResponse(url=f"/{DEFAULT_LANG}/terms-of-service", status_code=status.HTTP_308_PERMANENT_REDIRECT)
     return RedirectResponse(url_for('terms_of_service', lang=DEFAULT_LANG), status_code=status.HTTP_308_PERMANENT_REDIRECT)
 @app.get('/{lang}/terms-of-service', response_class=HTMLResponse)
 async def terms_of_service(request: Request, lang: Annotated[str, Path(title="2-letter language code", max_length=2, min_length=2, examples=["en","fr"])]):
-    return templates.TemplateResponse(name="tos.jinja", context={"request": request, "current_lang": lang, "lang_list": app.locale.lang_list, "page_title": app.locale.lang_str('terms_of_service', lang)})
+    return await content_page(request, "tos.jinja", lang, app.locale.lang_str('terms_of_service', lang))
 
 # ---- error pages ----
 
+# pre-rendered per language at startup (app.error_pages), name => (template, context of a language)
+ERROR_PAGES = {
+    "401": ("401.html", lambda lang: {"error": app.locale.lang_str('unauthorized', lang), "page_title": app.locale.lang_str('unauthorized_page_title', lang)}),
+    "403": ("403.html", lambda lang: {"page_title": app.locale.lang_str('forbidden_page_title', lang)}),
+    "404": ("404.html", lambda lang: {"page_title": app.locale.lang_str('not_found_page_title', lang)}),
+    "429": ("429.html", lambda lang: {"retry_after": ErrorPages.RETRY_AFTER, "page_title": app.locale.lang_str('rate_limited_page_title', lang)}),
+    "cas_unavailable": ("error.html", lambda lang: {"error": app.locale.lang_str('cas_unavailable', lang), "page_title": app.locale.lang_str('cas_unavailable_page_title', lang)}),
+}
+
+def error_lang(request: Request) -> str:
+    """
+    Language of an error page: from the URL ("/fr/..."), else the `lang` cookie, else the Accept-Language header
+    """
+    lang = request.scope["path"].split("/", 2)[1]
+    if lang in app.locale.lang_list:
+        return lang
+    return preferred_lang(request)
+
 @app.exception_handler(404)
 async def not_found_error_handler(request: Request, exc: Exception):
-    return HTMLResponse(templates.TemplateResponse(name="404.html", context={"request": request, "current_lang": DEFAULT_LANG}, status_code=404))
+    return app.error_pages.response(request, "404", error_lang(request), status_code=404)
     #return JSONResponse({"error": "Not Found"}, status_code=404)
 
 #@app.exception_handler(500)
@@ -645,17 +860,16 @@ async def not_found_error_handler(request: Request, exc: Exception):
 
 @app.exception_handler(403)
 async def forbidden_error_handler(request: Request, exc: Exception):
-    return HTMLResponse(templates.TemplateResponse(name="403.html", context={"request": request, "current_lang": DEFAULT_LANG}, status_code=403))
+    return app.error_pages.response(request, "403", error_lang(request), status_code=403)
 
 @app.exception_handler(Unauthorized)
-async def unauthorized_error_handler(request: Request):
-    error = "Unauthorized"
-    return HTMLResponse(templates.TemplateResponse(name="401.html", context={"request": request,"error": error, "current°lang": DEFAULT_LANG}, status_code=401))
+async def unauthorized_error_handler(request: Request, e: Unauthorized):
+    return app.error_pages.response(request, "401", error_lang(request), status_code=401)
 
 
 @app.exception_handler(RateLimited)
 async def rate_limit_error_handler(request: Request, e: RateLimited):
-    return HTMLResponse(templates.TemplateResponse(name="429.html", context={"request": request,"retry_after": e.retry_after, "current°lang": DEFAULT_LANG}, status_code=429))
+    return app.error_pages.response(request, "429", error_lang(request), status_code=429, retry_after=e.retry_after, headers={"Retry-After": str(max(1, round(e.retry_after)))})
 
 
 #@app.exception_handler(ClientSessionNotInitialized)
@@ -704,7 +918,7 @@ async def run_bot():
     else:
         logging.warning("Non-Linux system. INFO and DEBUG log files won't be available.")
 
-    #bot = Bot(logger=botRootLogger, logFormatter=botLogFormatter)
+    #bot = Bot(logger=botRootLogger, logFormatter=botLogFormatter, _rate_limiter=discord_rate_limiter, _guild_index=app.guild_index)
 
     # TODO: implement bot
     BOT_TOKEN = getenv("DISCORD_BOT_TOKEN")
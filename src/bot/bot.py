@@ -12,6 +12,8 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from ..locales import Locale
+from ..ratelimit import DiscordRateLimiter
+from ..guild_index import GuildIndex
 
 import logging.handlers
 import platform
@@ -24,9 +26,11 @@ logger = logging.getLogger("bot")
 
 class Bot(InteractionBot):
 
-    def __init__(self, _logger, _logFormatter, _debug=False):
+    def __init__(self, _logger, _logFormatter, _debug=False, _rate_limiter: DiscordRateLimiter = None, _guild_index: GuildIndex = None):
 
         self.locale = Locale(debug=_debug)
+        self.rate_limiter = _rate_limiter if _rate_limiter is not None else DiscordRateLimiter(max_wait=None, debug=_debug) # shared with the web app
+        self.guild_index = _guild_index if _guild_index is not None else GuildIndex() # shared with the web app
         self.logger = _logger
         logger = _logger
         self.logFormatter = _logFormatter
@@ -69,6 +73,15 @@ class Bot(InteractionBot):
             logger.info("| /!\ Cogs not loaded (see error above): " + ", ".join(self.cog_not_loaded))
         logger.info(f"| Bot Ready !")
         logger.info("-" * 50)
+        self.guild_index.load(guild.id for guild in self.guilds)
+
+    async def on_guild_join(self, guild: disnake.Guild) -> None:
+        logger.info(f"[Bot] Joined guild '{guild.name}:{guild.id}'")
+        self.guild_index.add(guild.id)
+
+    async def on_guild_remove(self, guild: disnake.Guild) -> None:
+        logger.info(f"[Bot] Removed from guild '{guild.name}:{guild.id}'")
+        self.guild_index.discard(guild.id)
 
     def load_commands(self) -> None:
         for extension in os.listdir(f"./cogs"):
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+import disnake
+from disnake import HTTPException
+
+from ..ratelimit import DiscordRateLimiter
+
+logger = logging.getLogger("bot")
+
+# rate limiter routes of the member edits (the guild is their major parameter)
+EDIT_MEMBER_ROUTE = "PATCH /guilds/{guild_id}/members/{user_id}"
+ADD_MEMBER_ROLE_ROUTE = "PUT /guilds/{guild_id}/members/{user_id}/roles/{role_id}"
+
+
+async def _rate_limited(rate_limiter: DiscordRateLimiter, route: str, major: Hashable, request: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Runs `request()` once `rate_limiter` lets it through, and tells the limiter how it went (as `DiscordAPI._send()`):
+    `update()` after an error response with its headers, `cancel()` otherwise. disnake doesn't expose the headers of
+    its successful responses: they leave the bucket as known (a success without headers isn't a route without limits).
+    """
+    await rate_limiter.acquire(route, major, max_wait=None)
+    try:
+        result = await request()
+    except HTTPException as ex:
+        headers = getattr(ex.response, "headers", None)
+        if headers is not None:
+            rate_limiter.update(route, major, headers, ex.status)
+        else:
+            rate_limiter.cancel(route, major)
+        raise
+    except BaseException:
+        rate_limiter.cancel(route, major)
+        raise
+    rate_limiter.cancel(route, major) # probe released, remaining and reset time kept
+    return result
+
+
+class RoleNotInGuildError(Exception):
+    def __init__(self, role: disnake.Role, guild: disnake.Guild) -> None:
+        super().__init__(f"The role  {role.name}:{role.id} is not part of the guild {guild.name}:{guild.id}.")
+
+
+async def update_member(member: disnake.Member, *, name: str, role: disnake.Role, rename: bool, rate_limiter: DiscordRateLimiter):
+    """Update the role and nickname of a given member for the associated guild (from old_bot/classes/utils.py)
+
+    Each edit first waits for its turn in `rate_limiter`, which is shared with the web app,
+    so that a guild update doesn't burst into Discord's rate limits.
+
+    Parameters
+    ----------
+    member : `disnake.Member`
+        The member to update
+    name : `str`
+        The nickname to set if `rename`
+    role : `disnake.Role`
+        The role to add
+    rename : `bool`
+        Does the guild force rename or not
+    rate_limiter : `DiscordRateLimiter`
+        The shared Discord rate limiter (`Bot.rate_limiter`)
+
+    Raise
+    -----
+    `RoleNotInGuildError`:
+        Raised if the provided role in not in the roles of the associated guild
+    """
+    if role not in member.guild.roles:
+        raise RoleNotInGuildError(role, member.guild)
+
+    if rename and (member.nick == None or member.nick != name):
+        try:
+            await _rate_limited(rate_limiter, EDIT_MEMBER_ROUTE, member.guild.id, lambda: member.edit(nick=f"{name}"))
+            logger.info(f"[Utils:update_member] [User:{member.id}] [Guild:{member.guild.id}] Set name={name}")
+        except HTTPException as ex:
+            logger.warning(
+                f'[Utils:update_member] [User:{member.id}] [Guild:{member.guild.id}] Not able to edit user "{member.name}:{member.id}" nick to "{name}": {ex}'
+            )
+    if role not in member.roles:
+        try:
+            await _rate_limited(rate_limiter, ADD_MEMBER_ROLE_ROUTE, member.guild.id, lambda: member.add_roles(role))
+            logger.info(f"[Utils:update_member] [User:{member.id}] [Guild:{member.guild.id}] Set role={role.id}")
+        except HTTPException as ex:
+            logger.error(
+                f'[Utils:update_member] [User:{member.id}] [Guild:{member.guild.id}] Not able to add ulb role "{role.name}:{role.id}" to ulb user "{member.name}:{member.id}": {ex}'
+            )
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+# Async CAS client, built on the CASAuth sketch in old/CASAuth.py (originally from DocHub: https://github.com/DocHub-ULB/DocHub)
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlencode
+from time import monotonic
+import asyncio
+import logging
+import zlib
+
+import anyio
+from httpx import AsyncBaseTransport, AsyncClient, HTTPError, Limits, Timeout
+from lxml import etree
+
+from utils import PoolStats, Timer
+
+logger = logging.getLogger("cas")
+
+
+class CASAuth:
+    """
+    Non-blocking replacement for python-cas' `CASClient`.
+
+    python-cas validates tickets with synchronous `requests` calls, which blocks the whole event loop
+    on every `/login` callback. This client does the same validation with one shared, pooled
+    `httpx.AsyncClient`, created by `init()` in the app lifespan and closed by `close()` on shutdown.
+    """
+    # ticket validation endpoints, per CAS protocol version
+    VALIDATE_PATHS = {1: "/validate", 2: "/serviceValidate", 3: "/p3/serviceValidate"}
+    PROXY_VALIDATE_PATHS = {1: "/validate", 2: "/proxyValidate", 3: "/p3/proxyValidate"}
+    # "single": one serviceValidate round trip, attributes read straight from its response
+    # "proxy": serviceValidate, then get a proxy ticket and validate it again (3 round trips, legacy)
+    VALIDATION_MODES = ("single", "proxy")
+
+    def __init__(self, server_url: str, service_url: str, version: int = 2, validate_path: Optional[str] = None, validation_mode: str = "single", timeout: float = 5, login_budget: float = 10, breaker: Optional["CircuitBreaker"] = None, debug: bool = False):
+        self.debug = debug
+        self.server_url = str(server_url).rstrip("/")
+        self.service_url = service_url
+        self.version = int(version)
+        if self.version not in self.VALIDATE_PATHS:
+            raise ValueError(f"Unsupported CAS protocol version: {version}, must be 1, 2 or 3")
+        self.validate_path = validate_path or self.VALIDATE_PATHS[self.version]
+        if validation_mode not in self.VALIDATION_MODES:
+            raise ValueError(f"Unsupported CAS validation mode: {validation_mode}, must be one of {self.VALIDATION_MODES}")
+        self.validation_mode = validation_mode
+        self.parser = CASResponseParser(debug=debug)
+        self.http_client: Optional[AsyncClient] = None
+        self.pool_stats = PoolStats()
+        # single-flight: concurrent callbacks with the same (single-use) ticket share one validation while it runs.
+        # Its result isn't kept afterwards: a ticket presented again later is sent to CAS, which rejects it
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.timeout = timeout # seconds, per CAS call
+        self.login_budget = login_budget # seconds, for the whole validation of a login (all its CAS calls)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def set_attributes_filter(self, attributes: Optional[Iterable[str]]):
+        """
+        Only keep these CAS attributes (keys of cas_attributes_filter.json) when parsing validation responses, None keeps all
+        """
+        self.parser = CASResponseParser(attributes, debug=self.debug)
+
+    async def init(self, transport: Optional[AsyncBaseTransport] = None):
+        """
+        Creates the shared connection pool to the CAS server,
+        `transport` replaces it (e.g. `httpx.ASGITransport` to an in-process CAS server for tests)
+        """
+        if self.http_client is not None:
+            return
+        self.http_client = AsyncClient(
+            transport=transport,
+            base_url=self.server_url,
+            limits=Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=Timeout(self.timeout),
+            event_hooks={"request": [self.pool_stats.on_request], "response": [self.pool_stats.on_response]},
+        )
+
+    async def close(self):
+        if self.http_client is None:
+            return
+        logger.info(f"CAS HTTP client pool stats: {self.pool_stats.as_dict()}")
+        await self.http_client.aclose()
+        self.http_client = None
+
+    def get_login_url(self) -> str:
+        return f"{self.server_url}/login?{urlencode({'service': self.service_url})}"
+
+    def get_logout_url(self, redirect_url: Optional[str] = None) -> str:
+        if redirect_url is None:
+            return f"{self.server_url}/logout"
+        return f"{self.server_url}/logout?{urlencode({'service': str(redirect_url)})}"
+
+    async def validate(self, ticket: str, timer: Optional[Timer] = None) -> Tuple[Optional[str], Dict]:
+        """
+        Validates the service ticket of a `/login` callback according to `validation_mode`.
+
+        Returns `(user, attributes)`, `user` is None if the ticket was rejected.
+        Each CAS round trip is recorded in `timer` ("cas-validate", "cas-proxy", "cas-proxy-validate"),
+        requests joining a validation already in flight for the same ticket record "cas-shared".
+        Raises `CasUnavailableError` without calling CAS while the circuit breaker is open,
+        `CasTimeoutError` if the validation takes longer than `login_budget`.
+        """
+        timer = timer if timer is not None else Timer()
+        task = self._inflight.get(ticket)
+        if task is None:
+            if not self.breaker.allow():
+                raise CasUnavailableError(f"CAS circuit breaker open, retry after {self.breaker.retry_after():.0f}s")
+            task = asyncio.ensure_future(self._validate(ticket, timer))
+            self._inflight[ticket] = task
+            task.add_done_callback(lambda _: self._inflight.pop(ticket, None))
+            # shielded: a client disconnecting must not cancel the validation shared with its duplicates
+            return await asyncio.shield(task)
+        logger.info("CAS validation: joining validation in flight for the same ticket")
+        with timer("cas-shared"):
+            return await asyncio.shield(task)
+
+    async def _validate(self, ticket: str, timer: Timer) -> Tuple[Optional[str], Dict]:
+        try:
+            with anyio.fail_after(self.login_budget):
+                user, attributes = await self._validate_ticket(ticket, timer)
+        except TimeoutError as e:
+            self.breaker.record_failure()
+            raise CasTimeoutError(f"CAS validation took longer than the {self.login_budget}s login budget") from e
+        except BaseException: # CAS unreachable, unexpected responses, ...
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return user, attributes
+
+    async def _validate_ticket(self, ticket: str, timer: Timer) -> Tuple[Optional[str], Dict]:
+        with timer("cas-validate"):
+            user, attributes, pgtiou = await self.verify_ticket(ticket) # pgtIou means Proxy Granting Ticket IOU
+        if self.validation_mode == "proxy" and user:
+            with timer("cas-proxy"):
+                proxy_ticket = await self.get_proxy_ticket(pgtiou) # get Proxy Ticket (PT) for Proxy Callback
+            with timer("cas-proxy-validate"):
+                proxy_user, proxy_attributes, proxy_pgtiou = await self.verify_ticket(proxy_ticket, proxy=True) # verify ticket again to get user details
+            if self.debug:
+                logger.debug(f"proxy_ticket: {proxy_ticket}")
+                logger.debug(f"proxy user, attributes, pgtiou: {proxy_user}, {proxy_attributes}, {proxy_pgtiou}")
+        logger.info(f"CAS validation (mode={self.validation_mode}): {timer}")
+        return user, attributes
+
+    async def verify_ticket(self, ticket: Optional[str], proxy: bool = False) -> Tuple[Optional[str], Dict, Optional[str]]:
+        """
+        Validates a service (or proxy) ticket with the CAS server.
+
+        Returns `(user, attributes, pgtiou)` like python-cas, `user` is None if the ticket was rejected.
+        Raises `CasRequestError` if the CAS server could not be reached, `CasParseError` on unexpected responses.
+        """
+        if not ticket:
+            return None, {}, None
+        path = self.PROXY_VALIDATE_PATHS[self.version] if proxy else self.validate_path
+        content = await self._get(path, {"ticket": ticket, "service": self.service_url})
+        try:
+            if self.version == 1:
+                return self.parser.parse_v1(content)
+            return self.parser.parse(content)
+        except CasRejectError as e:
+            logger.warning(f"CAS rejected ticket: {e}")
+            return None, {}, None
+
+    async def get_proxy_ticket(self, pgt: Optional[str]) -> Optional[str]:
+        """
+        Gets a Proxy Ticket (PT) from a Proxy Granting Ticket, None if there is no pgt (no proxy callback configured)
+        """
+        if not pgt:
+            return None
+        content = await self._get("/proxy", {"pgt": pgt, "targetService": self.service_url})
+        return self.parser.parse_proxy(content)
+
+    async def _get(self, path: str, params: Dict) -> bytes:
+        if self.http_client is None:
+            raise CasRequestError("CAS http client not initialized, call init() first")
+        try:
+            response = await self.http_client.get(path, params=params)
+        except HTTPError as e:
+            raise CasRequestError(f"{type(e).__name__} on {path}: {e}") from e
+        if response.status_code != 200:
+            raise CasRequestError(f"Unexpected HTTP response {response.status_code} on {path}")
+        return response.content
+
+
+class CASResponseParser:
+    """
+    Single-pass parser for CAS validation responses.
+
+    Walks the children of `cas:authenticationSuccess` once, picking `cas:user`, the proxy granting ticket IOU
+    and only the wanted attributes, matched on precomputed namespaced tags (no XPath evaluated per response).
+    Attributes are read from `cas:attributes` (CAS 3) or directly under `cas:authenticationSuccess` (some CAS 2 servers).
+    """
+    CAS_NS = "{http://www.yale.edu/tp/cas}"
+    SUCCESS = CAS_NS + "authenticationSuccess"
+    FAILURE = CAS_NS + "authenticationFailure"
+    USER = CAS_NS + "user"
+    ATTRIBUTES = CAS_NS + "attributes"
+    PGTIOU = CAS_NS + "proxyGrantingTicket"
+    PROXIES = CAS_NS + "proxies"
+    PROXY_SUCCESS = CAS_NS + "proxySuccess"
+    PROXY_TICKET = CAS_NS + "proxyTicket"
+
+    # shared parser: no DTD/entity resolution nor network access for responses coming from the network
+    _xml_parser = etree.XMLParser(resolve_entities=False, no_network=True, remove_blank_text=True, remove_comments=True, remove_pis=True)
+
+    def __init__(self, attributes: Optional[Iterable[str]] = None, debug: bool = False):
+        self.debug = debug
+        self.attributes = frozenset(attributes) if attributes is not None else None
+        # namespaced tag => attribute name, None means keep all attributes
+        self._wanted_tags = {self.CAS_NS + name: name for name in self.attributes} if self.attributes is not None else None
+
+    def parse(self, content: bytes) -> Tuple[str, Dict, Optional[str]]:
+        """
+        Parses a CAS 2/3 (XML) validation response, returns `(user, attributes, pgtiou)`.
+        Raises `CasRejectError` on `cas:authenticationFailure`, `CasParseError` on anything unexpected.
+        """
+        try:
+            root = etree.fromstring(content, self._xml_parser)
+        except etree.XMLSyntaxError as e:
+            raise CasParseError("INVALID_XML", content) from e
+
+        result = root[0] if len(root) else None
+        if result is None or result.tag != self.SUCCESS:
+            if result is not None and result.tag == self.FAILURE:
+                raise CasRejectError(result.get("code"), (result.text or "").strip())
+            raise CasParseError("UNKNOWN_STRUCTURE", content)
+
+        user = None
+        pgtiou = None
+        attributes = {}
+        for node in result:
+            tag = node.tag
+            if tag == self.USER:
+                user = node.text
+            elif tag == self.ATTRIBUTES:
+                for attr in node:
+                    self._add_attribute(attributes, attr)
+            elif tag == self.PGTIOU:
+                pgtiou = node.text
+            elif tag != self.PROXIES:
+                self._add_attribute(attributes, node)
+
+        if user is None:
+            logger.error("User has no netid in CAS response")
+            raise CasParseError("UNKNOWN_STRUCTURE", content)
+        return user, attributes, pgtiou
+
+    def _add_attribute(self, attributes: Dict, node):
+        tag = node.tag
+        if self._wanted_tags is None:
+            key = tag.rpartition("}")[2] # strip namespace
+        else:
+            key = self._wanted_tags.get(tag)
+        if self.debug:
+            logger.debug(f"CAS attribute: {tag} => {node.text}{'' if key else ' (filtered out)'}")
+        if key is None:
+            return
+        value = attributes.get(key)
+        if value is None:
+            attributes[key] = node.text
+        elif isinstance(value, list): # multi-valued attribute
+            value.append(node.text)
+        else:
+            attributes[key] = [value, node.text]
+
+    def parse_v1(self, content: bytes) -> Tuple[str, Dict, None]:
+        # CAS 1.0 response is plain text: "yes\n<user>\n" or "no\n\n"
+        lines = content.decode("utf-8", errors="replace").splitlines()
+        if len(lines) >= 2 and lines[0].strip() == "yes":
+            return lines[1].strip(), {}, None
+        raise CasRejectError("INVALID_TICKET", content)
+
+    SAMLP_SESSION_INDEX = "{urn:oasis:names:tc:SAML:2.0:protocol}SessionIndex"
+
+    def parse_logout_request(self, content: bytes) -> Optional[str]:
+        """
+        Parses a CAS Single Logout `samlp:LogoutRequest`, returns its session index (the service ticket of the login)
+        """
+        try:
+            root = etree.fromstring(content, self._xml_parser)
+        except (etree.XMLSyntaxError, ValueError) as e:
+            raise CasParseError("INVALID_XML", content) from e
+        for node in root:
+            if node.tag == self.SAMLP_SESSION_INDEX:
+                return (node.text or "").strip() or None
+        return None
+
+    def parse_proxy(self, content: bytes) -> Optional[str]:
+        try:
+            root = etree.fromstring(content, self._xml_parser)
+        except etree.XMLSyntaxError as e:
+            raise CasParseError("INVALID_XML", content) from e
+        result = root[0] if len(root) else None
+        if result is None or result.tag != self.PROXY_SUCCESS or not len(result) or result[0].tag != self.PROXY_TICKET:
+            logger.warning(f"CAS proxy ticket request failed: {content}")
+            return None
+        return result[0].text
+
+
+def _normalize_mail(value) -> Optional[str]:
+    if isinstance(value, list): # several addresses, keep the first one
+        value = next((item for item in value if item), None)
+    return value.strip().lower() if value else None
+
+def _split_multi_valued(value) -> List[str]:
+    # repeated XML elements are already parsed as a list, some CAS servers send one ";"-separated value instead
+    if isinstance(value, list):
+        return [item for item in value if item] # empty elements are parsed as None
+    return [part.strip() for part in value.split(";") if part.strip()]
+
+# per-attribute normalizers applied by AttributeProjection, keyed by CAS attribute name
+ATTRIBUTE_NORMALIZERS: Dict[str, Callable[[Any], Any]] = {
+    "mail": _normalize_mail,
+    "supannRoleEntite": _split_multi_valued,
+    "eduPersonAffiliation": _split_multi_valued,
+}
+
+
+class AttributeProjection:
+    """
+    Projection plan compiled once (in `init()`) from cas_attributes_filter.json: the wanted attribute keys,
+    in a fixed order, with their optional normalizer.
+
+    `apply()` projects the attributes of a CAS validation response in one pass into a compact `CASUser`,
+    which is stored in the session packed as a list (`CASUser.pack()`, `unpack()`) instead of a dict.
+    Packed values are positional, so the list starts with the `version` of the projection (a checksum of its keys):
+    sessions packed with another filter are dropped by `unpack()` rather than read with shifted values.
+    """
+    def __init__(self, attributes: Iterable[str], normalizers: Dict[str, Callable[[Any], Any]] = ATTRIBUTE_NORMALIZERS):
+        self.keys: Tuple[str, ...] = tuple(dict.fromkeys(attributes)) # unique, in filter order
+        self.wanted = frozenset(self.keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.version = zlib.crc32("\n".join(self.keys).encode("utf-8"))
+        self._steps = tuple((key, normalizers.get(key)) for key in self.keys)
+
+    def apply(self, user: str, attributes: Dict) -> "CASUser":
+        values = []
+        for key, normalizer in self._steps:
+            value = attributes.get(key)
+            if value is not None and normalizer is not None:
+                value = normalizer(value)
+            values.append(value)
+        return CASUser(self, user, tuple(values))
+
+    def unpack(self, packed) -> Optional["CASUser"]:
+        """
+        The `CASUser` of a session's packed user, None if there is none or it was packed with another filter
+        """
+        if not packed:
+            return None
+        if isinstance(packed, dict): # session from before the projection, {"user": ...}
+            return CASUser(self, packed.get("user"), (None,) * len(self.keys))
+        if packed[0] != self.version or len(packed) != len(self.keys) + 2:
+            logger.info("Session user packed with another CAS attributes filter, dropped")
+            return None
+        return CASUser(self, packed[1], tuple(packed[2:]))
+
+
+class CASUser:
+    """
+    CAS user and its projected attributes (see `AttributeProjection`)
+    """
+    __slots__ = ("projection", "user", "values")
+
+    def __init__(self, projection: AttributeProjection, user: str, values: Tuple):
+        self.projection = projection
+        self.user = user
+        self.values = values
+
+    def get(self, key: str, default: Any = None) -> Any:
+        i = self.projection.index.get(key)
+        if i is None or self.values[i] is None:
+            return default
+        return self.values[i]
+
+    def __getitem__(self, key: str) -> Any:
+        return self.values[self.projection.index[key]]
+
+    def pack(self) -> List:
+        return [self.projection.version, self.user, *self.values]
+
+    def as_dict(self) -> Dict:
+        return dict(zip(self.projection.keys, self.values))
+
+    def __str__(self) -> str:
+        return str(self.user)
+
+    def __repr__(self) -> str:
+        return f"CASUser(user={self.user!r}, {self.as_dict()!r})"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the CAS server dependency.
+
+    "closed": calls go through. After `failure_threshold` consecutive failures it becomes "open": calls are
+    refused right away for `reset_timeout` seconds. Then it is "half-open": one trial call goes through,
+    closing the breaker if it succeeds or opening it again if it fails.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(0, self.reset_timeout - (monotonic() - self.opened_at))
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("CAS circuit breaker closed, CAS server is reachable again")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_running or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial_running:
+                logger.error(f"CAS circuit breaker open after {self.failures} consecutive failure(s), refusing CAS logins for {self.reset_timeout}s")
+            self.opened_at = monotonic()
+        self._trial_running = False
+
+
+class CasError(Exception):
+    pass
+
+
+class CasRequestError(CasError):
+    pass
+
+
+class CasParseError(CasError):
+    pass
+
+
+class CasRejectError(CasError):
+    pass
+
+
+class CasTimeoutError(CasRequestError):
+    pass
+
+
+class CasUnavailableError(CasError):
+    pass
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import gzip
+import zlib
+from typing import Dict, Optional, Tuple
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils import accepted_encodings
+
+try:
+    import brotli
+except ImportError: # optional, gzip only without it
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+def supported_encodings() -> Tuple[str, ...]:
+    """
+    Content codings this server can produce, by preference order
+    """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Preferred content coding of ours accepted by an Accept-Encoding header, None for no compression
+    """
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in supported_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    """
+    `body` compressed with `encoding` ("br" or "gzip") at `level` (brotli quality 0-11, gzip level 1-9),
+    the maximum level by default (for bodies compressed once and cached)
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if level is None else level)
+    return gzip.compress(body, compresslevel=9 if level is None else level, mtime=0)
+
+
+class _StreamCompressor:
+    def __init__(self, encoding: str, level: int):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+            self.process, self.finish = self._compressor.process, self._compressor.finish
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # 31: gzip container
+            self.process, self.finish = self._compressor.compress, self._compressor.flush
+
+
+class CompressionMiddleware:
+    """
+    Compresses the text responses (HTML, JSON, ...) of at least `minimum_size` bytes with brotli or gzip,
+    per the request's Accept-Encoding. Pure ASGI: streamed responses are compressed chunk by chunk.
+
+    Left as is: redirects and other bodiless statuses, responses with a Content-Encoding already
+    (the page cache and the precompressed static files send theirs, compressed once), other content types
+    and `exclude_paths`. Original and compressed bytes are counted per route in `stats`.
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, gzip_level: int = 6, brotli_quality: int = 4, exclude_paths: Tuple[str, ...] = ("/static",), stats: Optional[Dict[str, Dict[str, int]]] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": gzip_level, "br": brotli_quality} # per request compression: fast levels
+        self.exclude_paths = tuple(exclude_paths)
+        self.stats = stats if stats is not None else {} # route => {"responses", "bytes_in", "bytes_out"}
+
+    def _count(self, scope: Scope, bytes_in: int, bytes_out: int):
+        route = scope.get("route")
+        stats = self.stats.setdefault(getattr(route, "path", "other"), {"responses": 0, "bytes_in": 0, "bytes_out": 0})
+        stats["responses"] += 1
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += bytes_out
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "HEAD" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+        encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                encoding = choose_encoding(value.decode("latin-1"))
+                break
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        compressor: Optional[_StreamCompressor] = None
+        passthrough = False
+        bytes_in = bytes_out = 0
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, compressor, passthrough, bytes_in, bytes_out
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                status = message["status"]
+                if (status < 200 or status in (204, 304) or 300 <= status < 400 or "content-encoding" in headers
+                        or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message # sent with the first body, once the body size is known
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if start_message is not None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True # too small to be worth it
+                    await send(start_message)
+                    await send(message)
+                    return
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                    compressor = _StreamCompressor(encoding, self.levels[encoding])
+                else:
+                    compressed = compress(body, encoding, self.levels[encoding])
+                    headers["Content-Length"] = str(len(compressed))
+                    self._count(scope, len(body), len(compressed))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                await send(start_message)
+                start_message = None
+            bytes_in += len(body)
+            chunk = compressor.process(body) + (b"" if more_body else compressor.finish())
+            bytes_out += len(chunk)
+            if not more_body:
+                self._count(scope, bytes_in, bytes_out)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
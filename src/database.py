@@ -122,6 +122,13 @@ class DB():
         except Exception as e:
             raise DatabaseError(f"An error occurred while deleting the guild {discord_guild_id}: {e}")
         
+    async def get_all_guild_ids() -> set[int]:
+        try:
+            logger.debug("Getting all guild IDs from the database")
+            return set(await Guild.objects.values_list("discord_guild_id", flatten=True))
+        except Exception as e:
+            raise DatabaseError(f"An error occurred while getting all guild IDs: {e}")
+
     async def get_all_user_guilds(cas_username: str | None = None, discord_user_id: int | None = None) -> list[Guild]:
         try:
             logger.debug(f"Getting all guilds for the user {cas_username} {discord_user_id} from the database")
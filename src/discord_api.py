@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+from hashlib import sha256
+from time import time
+import logging
+
+import anyio
+from typing import Any, Dict, List, Literal, NamedTuple, Optional, Tuple
+
+from httpx import AsyncBaseTransport, AsyncClient, Limits, Response, Timeout
+from fastapi_discord import DiscordOAuthClient, RateLimited, Unauthorized
+from fastapi_discord import User as DiscordUser
+from fastapi_discord import Guild as DiscordGuild
+from fastapi_discord.config import DISCORD_API_URL
+from fastapi_discord.exceptions import ClientSessionNotInitialized, InvalidRequest, InvalidToken, ScopeMissing
+
+from ratelimit import DiscordRateLimiter, RateLimitTimeout
+from utils import PoolStats, Timer, TTLCache
+
+logger = logging.getLogger("discord")
+
+
+class DiscordTokens(NamedTuple):
+    access_token: str
+    refresh_token: str
+    expires_at: float # epoch time of the access token expiry
+
+
+class DiscordAPI:
+    """
+    Discord OAuth2 and REST client, over one shared keep-alive (HTTP/2) `httpx.AsyncClient`
+    created by `init()` in the app lifespan and closed by `close()` on shutdown.
+
+    Replaces fastapi_discord's requests (and the per-call client of the old `revoke_discord_token()`),
+    `oauth` is still used for the client credentials, scopes and login URL.
+    Raises fastapi_discord's exceptions (`Unauthorized`, `RateLimited`, ...) like it.
+
+    Every request goes through `rate_limiter` (shared with the bot), which delays it to stay within Discord's
+    rate limits, and retries it once after a 429 if the wait is short enough.
+
+    `is_authenticated()` answers are cached by token hash: valid tokens for `token_cache_ttl` seconds,
+    invalid or revoked ones for `token_negative_ttl` seconds (a revoked token never becomes valid again).
+    """
+    TOKEN_ROUTE = "/oauth2/token"
+    REVOKE_ROUTE = "/oauth2/token/revoke"
+
+    def __init__(self, oauth: DiscordOAuthClient, http2: bool = True, rate_limiter: Optional[DiscordRateLimiter] = None, token_cache_ttl: float = 60, token_negative_ttl: float = 3600, debug: bool = False):
+        self.oauth = oauth
+        self.rate_limiter = rate_limiter if rate_limiter is not None else DiscordRateLimiter(debug=debug)
+        self.http2 = http2
+        self.debug = debug
+        self.http_client: Optional[AsyncClient] = None
+        self.pool_stats = PoolStats()
+        self.token_negative_ttl = token_negative_ttl
+        self._token_validity = TTLCache(ttl=token_cache_ttl, maxsize=10_000) # sha256(token) => valid
+        self.token_cache_stats = {"hits": 0, "misses": 0}
+
+    async def init(self, transport: Optional[AsyncBaseTransport] = None):
+        if self.http_client is not None:
+            return
+        self.http_client = AsyncClient(
+            transport=transport,
+            base_url=DISCORD_API_URL,
+            http2=self.http2,
+            limits=Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+            timeout=Timeout(10.0),
+            event_hooks={"request": [self.pool_stats.on_request], "response": [self.pool_stats.on_response]},
+        )
+
+    async def close(self):
+        if self.http_client is None:
+            return
+        logger.info(f"Discord HTTP client pool stats: {self.pool_stats.as_dict()}")
+        await self.http_client.aclose()
+        self.http_client = None
+
+    async def _send(self, method: str, route: str, major: Any = None, **kwargs) -> Response:
+        """
+        Sends a request within the rate limits of `route` (per `major` parameter, e.g. the user token),
+        retrying once after a 429. A response that is still a 429 is returned as is.
+        Raises `RateLimited` (like a 429) when the rate limiter would have to wait too long.
+        """
+        if self.http_client is None:
+            raise ClientSessionNotInitialized
+        limit_route = f"{method} {route}"
+        for attempt in range(2):
+            try:
+                await self.rate_limiter.acquire(limit_route, major)
+            except RateLimitTimeout as e:
+                raise RateLimited({"message": str(e), "retry_after": e.retry_after}, {})
+            try:
+                response = await self.http_client.request(method, route, **kwargs)
+            except BaseException:
+                self.rate_limiter.cancel(limit_route, major)
+                raise
+            body = None
+            if response.status_code == 429:
+                try:
+                    body = response.json()
+                except ValueError: # e.g. Cloudflare's HTML ban page
+                    pass
+            retry_after = self.rate_limiter.update(limit_route, major, response.headers, response.status_code, body)
+            if not retry_after or attempt or (self.rate_limiter.max_wait is not None and retry_after > self.rate_limiter.max_wait):
+                return response
+        return response
+
+    @staticmethod
+    def _json(response: Response) -> Any:
+        # None if the body isn't JSON, e.g. Cloudflare's HTML or plain text 429 and 5xx pages
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+    def _rate_limited(self, route: str, response: Response) -> RateLimited:
+        body = self._json(response)
+        body = dict(body) if isinstance(body, dict) else {}
+        body.setdefault("message", f"{route}: HTTP 429")
+        body.setdefault("retry_after", float(response.headers.get("Retry-After") or 1))
+        return RateLimited(body, response.headers)
+
+    async def request(self, route: str, token: Optional[str] = None, method: Literal["GET", "POST"] = "GET", **kwargs) -> Any:
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        # user token routes are rate limited per user
+        response = await self._send(method, route, self._token_key(token) if token else None, headers=headers, **kwargs)
+        if response.status_code == 401:
+            if token:
+                self._set_token_validity(token, False)
+            raise Unauthorized
+        if response.status_code == 429:
+            raise self._rate_limited(route, response)
+        if response.status_code >= 400:
+            raise InvalidRequest(f"{method} {route}: HTTP {response.status_code}")
+        if not response.content:
+            return None
+        return response.json()
+
+    async def get_token_response(self, payload: Dict[str, str]) -> Dict[str, Any]:
+        response = await self._send("POST", self.TOKEN_ROUTE, data={
+            "client_id": self.oauth.client_id,
+            "client_secret": self.oauth.client_secret,
+            **payload,
+        })
+        if response.status_code == 429:
+            raise self._rate_limited(self.TOKEN_ROUTE, response)
+        body = self._json(response)
+        if response.status_code == 400 and isinstance(body, dict) and body.get("error") == "invalid_grant":
+            raise InvalidToken("Authorization code or refresh token invalid, expired or revoked")
+        if response.status_code >= 400 or not isinstance(body, dict):
+            raise InvalidRequest(f"POST {self.TOKEN_ROUTE}: HTTP {response.status_code}")
+        return body
+
+    def _tokens(self, token_response: Dict[str, Any]) -> DiscordTokens:
+        access_token, refresh_token = token_response.get("access_token"), token_response.get("refresh_token")
+        if access_token is None or refresh_token is None:
+            raise InvalidToken("Tokens can't be None")
+        self._set_token_validity(access_token, True) # just issued by Discord
+        return DiscordTokens(access_token, refresh_token, time() + float(token_response.get("expires_in", 604800))) # 7 days by default
+
+    async def get_access_token(self, code: str) -> DiscordTokens:
+        return self._tokens(await self.get_token_response({
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": self.oauth.redirect_uri,
+        }))
+
+    async def refresh_access_token(self, refresh_token: str) -> DiscordTokens:
+        return self._tokens(await self.get_token_response({
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+        }))
+
+    @staticmethod
+    def _token_key(token: str) -> bytes:
+        # tokens are not kept in memory as is
+        return sha256(token.encode()).digest()
+
+    def _set_token_validity(self, token: str, valid: bool):
+        self._token_validity.set(self._token_key(token), valid, ttl=None if valid else self.token_negative_ttl)
+
+    async def is_authenticated(self, token: str) -> bool:
+        """
+        Whether Discord still accepts `token`, from the validity cache when possible (no round trip to Discord).
+        """
+        valid = self._token_validity.get(self._token_key(token))
+        if valid is not None:
+            self.token_cache_stats["hits"] += 1
+            return valid
+        self.token_cache_stats["misses"] += 1
+        try:
+            await self.request("/oauth2/@me", token)
+            valid = True
+        except Unauthorized:
+            valid = False
+        self._set_token_validity(token, valid)
+        return valid
+
+    async def get_user(self, token: str) -> DiscordUser:
+        if "identify" not in self.oauth.scopes:
+            raise ScopeMissing("identify")
+        return DiscordUser(**(await self.request("/users/@me", token)))
+
+    async def get_user_guilds(self, token: str) -> List[DiscordGuild]:
+        if "guilds" not in self.oauth.scopes:
+            raise ScopeMissing("guilds")
+        return [DiscordGuild(**guild) for guild in await self.request("/users/@me/guilds", token)]
+
+    async def get_user_and_guilds(self, token: str, timer: Optional[Timer] = None) -> Tuple[DiscordUser, Optional[List[DiscordGuild]]]:
+        """
+        Fetches the user and their guilds concurrently, timed in `timer` ("discord-user", "discord-guilds").
+        The guilds are None if they can't be fetched (e.g. missing "guilds" scope), the user is required:
+        its errors are raised (and cancel the guilds request).
+        """
+        timer = timer if timer is not None else Timer()
+        results: Dict[str, Any] = {"guilds": None}
+
+        async def fetch_user():
+            with timer("discord-user"):
+                results["user"] = await self.get_user(token)
+
+        async def fetch_guilds():
+            try:
+                with timer("discord-guilds"):
+                    results["guilds"] = await self.get_user_guilds(token)
+            except ScopeMissing:
+                logger.error("ScopeMissing error in Discord API Client: missing \"guilds\" in scopes -> ignoring user guilds")
+            except Exception as e:
+                logger.error(f"get_user_and_guilds: can't get user guilds -> ignoring them: {e!r}")
+
+        try:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(fetch_user)
+                tg.start_soon(fetch_guilds)
+        except BaseExceptionGroup as group:
+            raise group.exceptions[0] # only fetch_user raises, keep its exception (Unauthorized, RateLimited, ...) for the app's handlers
+        return results["user"], results["guilds"]
+
+    async def revoke_tokens(self, access_token: Optional[str], refresh_token: Optional[str], user: Optional[str] = None, timer: Optional[Timer] = None) -> bool:
+        """
+        Revokes the access and refresh tokens of a user concurrently, timed in `timer` ("discord-revoke-access", "discord-revoke-refresh").
+        """
+        timer = timer if timer is not None else Timer()
+        revoked = {"access_token": access_token is None, "refresh_token": refresh_token is None}
+
+        async def revoke(token: str, token_type: str, name: str):
+            with timer(name):
+                revoked[token_type] = await self.revoke_token(token, token_type, user)
+
+        try:
+            async with anyio.create_task_group() as tg:
+                if access_token is not None:
+                    tg.start_soon(revoke, access_token, "access_token", "discord-revoke-access")
+                if refresh_token is not None:
+                    tg.start_soon(revoke, refresh_token, "refresh_token", "discord-revoke-refresh")
+        except BaseExceptionGroup as group:
+            raise group.exceptions[0]
+        return all(revoked.values())
+
+    async def revoke_token(self, token: str, token_type: Optional[str] = None, user: Optional[str] = None) -> bool:
+        """
+        Discord user token revocation (which is missing from fastapi-discord).
+        The token is cached as invalid right away, whatever Discord answers: the session forgets it anyway.
+        """
+        self._set_token_validity(token, False)
+        try:
+            response = await self._send(
+                "POST", self.REVOKE_ROUTE,
+                data={"token": token, "token_type_hint": token_type},
+                auth=(self.oauth.client_id, self.oauth.client_secret),
+            )
+        except RateLimited as e:
+            logger.error(f"revoke_token: You are being Rate Limited. Retry after: {e.retry_after}")
+            return False
+        if response.status_code == 200:
+            if self.debug:
+                logger.debug(f"revoke_token: Discord token (type:{token_type}) revoked successfully for user:{user}.")
+            return True
+        elif response.status_code == 401:
+            logger.error("revoke_token: 401 This AccessToken does not have the necessary scope.")
+        elif response.status_code == 429:
+            logger.error(f"revoke_token: 429 You are being Rate Limited. Retry after: {response.json()['retry_after']}")
+        else:
+            logger.error(f"revoke_token: Unexpected HTTP response {response.status_code}")
+        return False
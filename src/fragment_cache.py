@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import logging
+import secrets
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Tuple
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+logger = logging.getLogger("pages")
+
+
+class FragmentCache:
+    """
+    Rendered template fragments, by (template, position, compilation, key values).
+    The oldest fragments are evicted once it holds more than `maxsize` of them.
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._fragments: OrderedDict = OrderedDict() # key => rendered fragment (Markup)
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get_or_render(self, key: Tuple[Hashable, ...], render: Callable[[], Any]) -> Any:
+        fragment = self._fragments.get(key)
+        if fragment is not None:
+            self.stats["hits"] += 1
+            return fragment
+        self.stats["misses"] += 1
+        fragment = self._fragments[key] = render()
+        while len(self._fragments) > self.maxsize:
+            self._fragments.popitem(last=False)
+        return fragment
+
+    def invalidate(self, *_):
+        """
+        Clears the cache, fragments are rendered again on their next use. Usable as a `Locale.on_reload()` callback.
+        """
+        if self._fragments:
+            self._fragments.clear()
+            self.stats["invalidations"] += 1
+            logger.info("Template fragment cache cleared")
+
+    def __len__(self) -> int:
+        return len(self._fragments)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    `{% cache key, ... %}...{% endcache %}` Jinja tag: the block is rendered once per value of its keys
+    and reused by the next renders, from `environment.fragment_cache` (a `FragmentCache`).
+
+    The keys must cover everything the block depends on (e.g. `current_lang`, and `request.base_url` if it
+    uses `url_for()`). Each compilation of a template gets its own keys, so a changed template
+    never gets the fragments of its previous version.
+
+    Example
+    -------
+    >>> {% cache "footer", current_lang, request.base_url %}{{ lang_str('footer', current_lang) }}{% endcache %}
+
+    """
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        keys: List[nodes.Expr] = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            keys.append(parser.parse_expression())
+        fragment_id = nodes.Const(f"{parser.name}:{lineno}:{secrets.token_hex(8)}") # unique per compilation
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(self.call_method("_cache", [fragment_id, nodes.List(keys)]), [], [], body).set_lineno(lineno)
+
+    def _cache(self, fragment_id: str, keys: List[Any], caller: Callable[[], Any]) -> Any:
+        return self.environment.fragment_cache.get_or_render((fragment_id, *(str(key) for key in keys)), caller)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import logging
+from typing import Iterable, List, Optional, Set
+
+logger = logging.getLogger("guilds")
+
+
+class GuildIndex:
+    """
+    In-memory set of the IDs of the guilds the bot is in, so that the guilds shared by a user and the bot
+    are one set intersection (instead of a database query and a list scan per login).
+
+    Loaded from the `Guild` table at startup (`DB.get_all_guild_ids()`) and from the bot's guilds when it is ready,
+    then kept up to date by the bot's `on_guild_join`/`on_guild_remove` events.
+    Until one of the loads succeeds, `loaded` is False and `intersect()` returns None: the shared guilds are unknown,
+    not none.
+    """
+    def __init__(self, guild_ids: Optional[Iterable[int]] = None):
+        self._ids: Set[int] = set(guild_ids or ())
+        self.loaded = guild_ids is not None
+
+    def load(self, guild_ids: Iterable[int]):
+        # new set swapped in at once, intersect() never sees a half loaded index
+        self._ids = {int(guild_id) for guild_id in guild_ids}
+        self.loaded = True
+        logger.info(f"Bot guilds index loaded: {len(self._ids)} guilds")
+
+    def add(self, guild_id: int):
+        self._ids.add(int(guild_id))
+
+    def discard(self, guild_id: int):
+        self._ids.discard(int(guild_id))
+
+    def intersect(self, user_guild_ids: Iterable[int | str]) -> Optional[List[int]]:
+        """
+        IDs of the guilds among `user_guild_ids` (ints or the strings of the Discord API) that the bot is in,
+        None if the index isn't loaded yet
+        """
+        if not self.loaded:
+            return None
+        return list(self._ids.intersection(map(int, user_guild_ids)))
+
+    def __contains__(self, guild_id: int) -> bool:
+        return int(guild_id) in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
@@ -1,22 +1,104 @@
-from os import getenv, listdir, path
+from collections import OrderedDict
+from os import getenv, listdir, path, stat
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import asyncio
 import json
 import logging
 import sys
 
+import anyio
+import anyio.to_thread
+
 DEFAULT_LANG = getenv("DEFAULT_LANG", "en")
 #DEBUG=True if getenv("DEBUG") or getenv("DEBUG") is not None or getenv("DEBUG") != "" else False
 
 logger = logging.getLogger("lang")
 
+
+class LocaleData(NamedTuple):
+    """
+    Everything loaded from the locale files, swapped as a whole on reload.
+    """
+    languages: Dict[str, Dict[str, str]] # lang code => strings of its file
+    lang_list: List[str]
+    catalogs: Dict[str, Dict[str, str]] # lang code => all strings, with default language fallbacks
+    resolution: Dict[str, str] # accepted code => supported lang code
+    default_catalog: Dict[str, str]
+
+
 class Locale:
-    def __init__(self, debug: bool = False):
+    """
+    Translation strings of the locales/*.json files.
+
+    At load time, one catalog per language is built with the missing strings already taken from
+    the default language (`catalogs`), and a table maps the accepted language codes ("fr", "FR", "fr_BE"...)
+    to the supported ones (`resolution`), so that `lang_str()` is two dict lookups.
+
+    `negotiate()` picks the language of an Accept-Language header, the last `negotiation_cache_size`
+    header values are memoized (browsers of the same language send the same few values).
+
+    `start_watching()` polls the locale files every `watch_interval` seconds (in a worker thread) and reloads
+    them when they change: the new `LocaleData` is built off the event loop then swapped in one assignment,
+    readers never see half a reload. `version` counts the reloads, `on_reload()` callbacks are called after each.
+    """
+    def __init__(self, debug: bool = False, negotiation_cache_size: int = 256, watch_interval: float = 2):
         self.debug = debug
-        self.languages = {}
-        self.lang_list = []
+        self.negotiation_cache_size = negotiation_cache_size
+        self._negotiated: OrderedDict = OrderedDict() # Accept-Language header => lang code or None
+        self.negotiation_stats = {"hits": 0, "misses": 0}
         self.locales_path = path.join(path.dirname(__file__),"../locales/")
+        self.watch_interval = watch_interval
+        self.version = 0
+        self._callbacks: List[Callable[[int], None]] = []
+        self._watch_task: Optional[asyncio.Task] = None
 
-        #for file in listdir(path.join(path.dirname(__file__))):
+        self._mtimes = self._scan()
+        self._failed_mtimes: Optional[Dict[str, Tuple[int, int]]] = None # of the last reload that failed, not retried until the files change again
+        self._data = self._load()
+        if len(self._data.languages) == 0:
+            logger.error("No locale files found, must at least have 1, exiting...")
+            sys.exit(1)
+
+    @property
+    def languages(self) -> Dict[str, Dict[str, str]]:
+        return self._data.languages
+
+    @property
+    def lang_list(self) -> List[str]:
+        return self._data.lang_list
+
+    @property
+    def catalogs(self) -> Dict[str, Dict[str, str]]:
+        return self._data.catalogs
+
+    @property
+    def resolution(self) -> Dict[str, str]:
+        return self._data.resolution
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        """
+        (mtime, size) of the locale files, to detect changes
+        """
+        mtimes = {}
         for file in listdir(self.locales_path):
+            if file.endswith(".json"):
+                try:
+                    file_stat = stat(path.join(self.locales_path, file))
+                except OSError: # deleted meanwhile
+                    continue
+                mtimes[file] = (file_stat.st_mtime_ns, file_stat.st_size)
+        return mtimes
+
+    def _load(self, strict: bool = False) -> LocaleData:
+        """
+        Loads the locale files. With `strict`, a file that can't be loaded raises (to keep the previous strings on reload)
+        instead of being skipped.
+        """
+        languages = {}
+        lang_list = []
+        resolution = {}
+        #for file in listdir(path.join(path.dirname(__file__))):
+        for file in sorted(listdir(self.locales_path)):
             if not file.endswith(".json"): #only get json files
                 continue
             lang_code = file.split(".")[0] # get filename without extension
@@ -28,23 +110,132 @@ class Locale:
             elif len(lang_code) != 2: # filename should be a 2-letter language code like "en.json"
                 continue
             lang_code = lang_code.lower()
+            file_code = file.split(".")[0]
             logger.info(f"Found locale file: {self.locales_path}{file} => lang_code: {lang_code}")
             try:
                 with open(path.join(self.locales_path, file), "r", encoding="utf-8") as lang_file:
-                    self.languages[lang_code] = json.load(lang_file) # load json file as lang dict
-                    self.lang_list.append(lang_code)
+                    languages[lang_code] = json.load(lang_file) # load json file as lang dict
+                    lang_list.append(lang_code)
+                for code in (lang_code, lang_code.upper(), file_code, file_code.lower(), file_code.replace("_", "-"), file_code.replace("_", "-").lower()):
+                    resolution[code] = lang_code
                 logger.info(f"Successfully loaded {lang_code} locale file")
             except Exception as e:
                 logger.error(f"Failed to load {lang_code} locale file: {e}")
+                if strict:
+                    raise
+
+        default_strings = languages.get(DEFAULT_LANG, {})
+        catalogs = {lang_code: {**default_strings, **strings} for lang_code, strings in languages.items()}
+        return LocaleData(languages, lang_list, catalogs, resolution, catalogs.get(DEFAULT_LANG, {}))
+
+    def on_reload(self, callback: Callable[[int], None]):
+        """
+        Calls `callback(version)` after each reload of the locale files (e.g. to clear caches of rendered pages).
+        """
+        self._callbacks.append(callback)
+
+    async def reload(self) -> bool:
+        """
+        Reloads the locale files if they changed since the last load. Returns whether they were reloaded.
+        """
+        mtimes = await anyio.to_thread.run_sync(self._scan)
+        if mtimes == self._mtimes or mtimes == self._failed_mtimes:
+            return False
+        try:
+            data = await anyio.to_thread.run_sync(self._load, True)
+            if len(data.languages) == 0:
+                raise ValueError("no locale file found")
+        except Exception as e:
+            logger.error(f"Locale files not reloaded, keeping the current strings: {e}")
+            self._failed_mtimes = mtimes # retried once they change again (e.g. the file was being written)
+            return False
+        self._mtimes = mtimes
+        self._failed_mtimes = None
+        self._data = data # atomic swap, lang_str() reads self._data once per call
+        self._negotiated = OrderedDict()
+        self.version += 1
+        logger.info(f"Locale files reloaded (version {self.version}): {', '.join(data.lang_list)}")
+        for callback in self._callbacks:
+            try:
+                callback(self.version)
+            except Exception as e:
+                logger.error(f"Locale reload callback {callback!r} failed: {e!r}")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Locale files watch failed: {e!r}")
+
+    def start_watching(self):
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+    def _parse_accept_language(self, header: str) -> Optional[str]:
+        """
+        First supported language of an Accept-Language header ("fr-BE,fr;q=0.9,en;q=0.8"), by decreasing q-value
+        then header order. A region falls back to its language ("fr-BE" => "fr"). None if none is supported.
+        """
+        ranges = []
+        for position, item in enumerate(header.split(",")):
+            tag, *params = item.split(";")
+            tag = tag.strip().lower()
+            quality = 1.0
+            for param in params:
+                name, _, value = param.strip().partition("=")
+                if name.strip() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if tag and tag != "*" and quality > 0:
+                ranges.append((-quality, position, tag))
+        resolution = self._data.resolution
+        for _, _, tag in sorted(ranges):
+            lang = resolution.get(tag) or resolution.get(tag.split("-")[0])
+            if lang is not None:
+                return lang
+        return None
+
+    def negotiate(self, header: Optional[str]) -> Optional[str]:
+        """
+        Supported language code preferred by an Accept-Language header, None if the header is missing
+        or none of its languages is supported.
+        """
+        if not header:
+            return None
+        negotiated = self._negotiated
+        try:
+            lang = negotiated[header]
+        except KeyError:
+            self.negotiation_stats["misses"] += 1
+            lang = negotiated[header] = self._parse_accept_language(header)
+            if len(negotiated) > self.negotiation_cache_size:
+                negotiated.popitem(last=False)
+            if self.debug:
+                logger.debug(f"Accept-Language: {header} => {lang}")
+            return lang
+        self.negotiation_stats["hits"] += 1
+        negotiated.move_to_end(header)
+        return lang
 
-        if len(self.languages) == 0:
-            logger.error("No locale files found, must at least have 1, exiting...")
-            sys.exit(1)
-    
     def lang_str(self, string: str, user_lang: str) -> str:
-        if user_lang not in self.languages.keys():
+        data = self._data
+        catalog = data.catalogs.get(user_lang)
+        if catalog is None:
             if self.debug:
                 logger.debug(f"'{string}' translation in {user_lang} not found, using default language ({DEFAULT_LANG})")
-            user_lang = DEFAULT_LANG
-        return self.languages[user_lang].get(string, self.languages[DEFAULT_LANG].get(string, string))
-
+            catalog = data.catalogs.get(data.resolution.get(user_lang), data.default_catalog)
+        return catalog.get(string, string)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from hashlib import sha256
+from os import path, stat, walk
+from time import perf_counter
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+import anyio
+import anyio.to_thread
+from fastapi.responses import HTMLResponse, Response
+from fastapi.templating import Jinja2Templates
+from starlette.requests import Request
+from starlette.types import ASGIApp
+
+from compression import choose_encoding, compress, supported_encodings
+from locales import Locale
+
+logger = logging.getLogger("pages")
+
+
+def site_request(app: ASGIApp, base_url: str, path: str = "/") -> Request:
+    """
+    A GET request for `path` on `base_url` (the site URL), to render templates independently of the client's
+    Host header: `url_for()` links are absolute to the site URL.
+    """
+    url = urlsplit(base_url)
+    port = url.port or (443 if url.scheme == "https" else 80)
+    return Request({
+        "type": "http", "method": "GET", "scheme": url.scheme, "server": (url.hostname, port),
+        "path": path, "root_path": url.path.rstrip("/"), "query_string": b"",
+        "headers": [(b"host", url.netloc.encode("latin-1"))], "app": app, "router": app.router,
+    })
+
+
+class CachedPage(NamedTuple):
+    body: bytes
+    etag: str # strong ETag, quoted
+    encoded: Dict[str, bytes] # content coding => compressed body, compressed on first request
+
+
+class PageCache:
+    """
+    Rendered pages whose content only depends on the language (help, about, privacy policy, terms of service),
+    kept as bytes and served with a strong ETag, `Cache-Control` and 304 answers to `If-None-Match`.
+
+    Pages are rendered on their first request, per (template, language), for `base_url` (the site URL) rather than
+    the client's Host header: `url_for()` links are absolute to it. Only the languages of `Locale.lang_list` are cached.
+    The cache is cleared when the locale files are reloaded (`Locale.on_reload(page_cache.invalidate)`)
+    and when a template file changes (`start_watching()` polls them every `watch_interval` seconds).
+
+    With `compress`, pages are also kept brotli/gzip compressed (at the maximum level, once per page and coding,
+    in a worker thread) and served per Accept-Encoding, each coding with its own ETag: `CompressionMiddleware`
+    lets them through.
+
+    Example
+    -------
+    >>> return await page_cache.response(request, "help.jinja", lang, {"page_title": ...})
+
+    """
+    def __init__(self, templates: Jinja2Templates, app: ASGIApp, base_url: str, max_age: int = 300, watch_interval: float = 2, compress: bool = True, debug: bool = False):
+        self.templates = templates
+        self.app = app
+        self.base_url = base_url
+        self.compress = compress
+        self.max_age = max_age
+        self.watch_interval = watch_interval
+        self.debug = debug
+        self.cache_control = f"public, max-age={max_age}"
+        self._pages: Dict[Tuple[str, str], CachedPage] = {} # (template, lang) => CachedPage
+        self._mtimes = self._scan()
+        self._watch_task: Optional[asyncio.Task] = None
+        self._callbacks: List[Callable[[], None]] = []
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0, "compressed": 0}
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        """
+        (mtime, size) of the template files, to detect changes
+        """
+        mtimes = {}
+        for directory in self.templates.env.loader.searchpath:
+            for root, _, files in walk(directory):
+                for file in files:
+                    try:
+                        file_stat = stat(path.join(root, file))
+                    except OSError: # deleted meanwhile
+                        continue
+                    mtimes[path.join(root, file)] = (file_stat.st_mtime_ns, file_stat.st_size)
+        return mtimes
+
+    def render(self, request: Request, name: str, lang: str, context: Dict[str, Any]) -> CachedPage:
+        page = self._pages.get((name, lang))
+        if page is not None:
+            self.stats["hits"] += 1
+            return page
+        self.stats["misses"] += 1
+        body = self.templates.get_template(name).render({
+            **context, "request": site_request(self.app, self.base_url, request.scope["path"]), "current_lang": lang,
+        }).encode("utf-8") # the same page whatever the client's Host header
+        page = self._pages[(name, lang)] = CachedPage(body, f'"{sha256(body).hexdigest()[:32]}"', {})
+        if self.debug:
+            logger.debug(f"Page {name} ({lang}) rendered: {len(body)} bytes, ETag {page.etag}")
+        return page
+
+    async def response(self, request: Request, name: str, lang: str, context: Dict[str, Any]) -> Response:
+        """
+        The page `name` in `lang` from the cache (rendered with `context` if it isn't cached yet),
+        or a 304 if the client's `If-None-Match` has its ETag.
+        """
+        page = self.render(request, name, lang, context)
+        body = page.body
+        headers = {"ETag": page.etag, "Cache-Control": self.cache_control}
+        encoding = choose_encoding(request.headers.get("Accept-Encoding")) if self.compress else None
+        if encoding is not None:
+            body = page.encoded.get(encoding)
+            if body is None:
+                body = page.encoded[encoding] = await anyio.to_thread.run_sync(compress, page.body, encoding)
+                self.stats["compressed"] += 1
+            headers["ETag"] = f'{page.etag[:-1]}-{encoding}"' # one ETag per representation
+            headers["Content-Encoding"] = encoding
+        if self.compress:
+            headers["Vary"] = "Accept-Encoding"
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            etags = {etag.strip().removeprefix("W/") for etag in if_none_match.split(",")} # weak comparison, RFC 9110 13.1.2
+            if headers["ETag"] in etags or "*" in etags:
+                self.stats["not_modified"] += 1
+                return Response(status_code=304, headers=headers)
+        return HTMLResponse(body, headers=headers)
+
+    def invalidate(self, *_):
+        """
+        Clears the cache, pages are rendered again on their next request. Usable as a `Locale.on_reload()` callback.
+        """
+        if self._pages:
+            self._pages = {}
+            self.stats["invalidations"] += 1
+            logger.info("Page cache cleared")
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def on_template_change(self, callback: Callable[[], None]):
+        """
+        Calls `callback()` when a template file changes (detected by `start_watching()`), after clearing the cache.
+        """
+        self._callbacks.append(callback)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                mtimes = await anyio.to_thread.run_sync(self._scan)
+                if mtimes != self._mtimes:
+                    self._mtimes = mtimes
+                    logger.info("Template files changed")
+                    self.invalidate()
+                    for callback in self._callbacks:
+                        callback()
+            except Exception as e:
+                logger.error(f"Template files watch failed: {e!r}")
+
+    def start_watching(self):
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+
+class ErrorPages:
+    """
+    Error pages rendered once per language by `render_all()` (at startup, and again when the locales or the templates
+    change), served as bytes without any template rendering: scanners make 404 the most frequent response.
+
+    `pages` maps a page name to its template and a function returning its context for a language.
+    They are rendered without a client request, for `base_url` (the site URL), so `url_for()` links are absolute to it,
+    and with `lang_links_home`: the language switcher links to the home page of each language, not to the failing path.
+    `RETRY_AFTER` in a context is replaced at serve time by `response(..., retry_after=)`, as a bytes substitution.
+
+    With `compress`, pages are also kept brotli/gzip compressed (by `render_all()`, at the maximum level) and served
+    per Accept-Encoding, so `CompressionMiddleware` lets them through. Pages with `RETRY_AFTER` differ per response:
+    they are left to the middleware.
+
+    Example
+    -------
+    >>> error_pages = ErrorPages(templates, app, locale, "https://example.org", {"404": ("404.html", lambda lang: {})})
+    >>> error_pages.render_all()
+    >>> return error_pages.response(request, "404", "fr", status_code=404)
+
+    """
+    RETRY_AFTER = "__RETRY_AFTER__"
+
+    def __init__(self, templates: Jinja2Templates, app: ASGIApp, locale: Locale, base_url: str, pages: Dict[str, Tuple[str, Callable[[str], Dict[str, Any]]]], compress: bool = True, debug: bool = False):
+        self.templates = templates
+        self.app = app
+        self.locale = locale
+        self.base_url = base_url
+        self.pages = pages
+        self.compress = compress
+        self.debug = debug
+        self._rendered: Dict[Tuple[str, str], bytes] = {} # (page, lang) => body
+        self._encoded: Dict[Tuple[str, str, str], bytes] = {} # (page, lang, content coding) => compressed body
+
+    def render_all(self, *_):
+        """
+        Renders every page in every language, swapped in at once. Usable as a `Locale.on_reload()` callback.
+        """
+        start = perf_counter()
+        request = site_request(self.app, self.base_url)
+        rendered, encoded = {}, {}
+        for name, (template, context) in self.pages.items():
+            for lang in self.locale.lang_list:
+                try:
+                    body = rendered[(name, lang)] = self.templates.get_template(template).render({
+                        **context(lang), "request": request, "current_lang": lang, "lang_list": self.locale.lang_list,
+                        "lang_links_home": True,
+                    }).encode("utf-8")
+                except Exception as e:
+                    logger.error(f"Error page {name} ({lang}) not rendered: {e!r}")
+                    continue
+                if self.compress and self.RETRY_AFTER.encode("utf-8") not in body:
+                    for encoding in supported_encodings():
+                        encoded[(name, lang, encoding)] = compress(body, encoding)
+        self._rendered, self._encoded = rendered, encoded
+        logger.info(f"Error pages rendered: {len(rendered)} ({len(encoded)} compressed) in {(perf_counter() - start) * 1000:.1f} ms")
+
+    def response(self, request: Request, name: str, lang: str, status_code: int, retry_after: Optional[float] = None, headers: Optional[Dict[str, str]] = None) -> HTMLResponse:
+        """
+        The page `name` in `lang`, compressed per the request's Accept-Encoding if it was compressed by `render_all()`
+        """
+        headers = dict(headers or {})
+        body = self._rendered.get((name, lang))
+        if body is None:
+            body = f"<h1>{status_code}</h1>".encode("utf-8") # the template doesn't render, see the logs
+        elif retry_after is not None:
+            body = body.replace(self.RETRY_AFTER.encode("utf-8"), str(retry_after).encode("utf-8"))
+        elif self.compress:
+            encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+            encoded = self._encoded.get((name, lang, encoding))
+            if encoded is not None:
+                body = encoded
+                headers["Content-Encoding"] = encoding
+                headers["Vary"] = "Accept-Encoding"
+        return HTMLResponse(body, status_code=status_code, headers=headers)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# Discord rate limits, see https://discord.com/developers/docs/topics/rate-limits
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from typing import Any, Deque, Dict, Hashable, Mapping, Optional, Tuple
+
+logger = logging.getLogger("ratelimit")
+
+
+class RateLimitTimeout(Exception):
+    """
+    Raised by `DiscordRateLimiter.acquire()` when a request would have to wait more than `max_wait` seconds.
+    """
+    def __init__(self, route: str, retry_after: float):
+        self.route = route
+        self.retry_after = retry_after
+        super().__init__(f"{route}: rate limited for {retry_after:.2f}s")
+
+
+class RateLimitBucket:
+    """
+    What is known of one Discord rate limit bucket: requests left until `reset_at` (monotonic time),
+    `remaining` is None until a response told it. While it is unknown, only one request (the probe) is sent,
+    unless the route is known to answer without rate limit headers (`unlimited`).
+    """
+    __slots__ = ("remaining", "reset_at", "lock", "probe", "unlimited")
+
+    def __init__(self):
+        self.remaining: Optional[int] = None
+        self.reset_at: float = 0
+        self.lock = asyncio.Lock()
+        self.probe: Optional[asyncio.Event] = None # set when the probe's response is known
+        self.unlimited = False
+
+    def end_probe(self):
+        if self.probe is not None:
+            self.probe.set()
+            self.probe = None
+
+    def delay(self, now: float) -> float:
+        if self.reset_at <= now:
+            self.remaining = None # reset, the next response tells the new budget
+            return 0
+        if self.remaining is not None and self.remaining <= 0:
+            return self.reset_at - now
+        return 0
+
+
+class DiscordRateLimiter:
+    """
+    Schedules outbound Discord requests so that they stay within Discord's rate limits instead of hitting 429s.
+    One instance is shared by the web app (`DiscordAPI`) and the bot (`bot.utils.update_member()`),
+    since they share the same outbound IP.
+
+    - per bucket: learnt from the `X-RateLimit-Bucket`, `X-RateLimit-Remaining` and `X-RateLimit-Reset-After`
+      headers of the responses. A bucket is per route and "major parameter" (guild ID, user token, ...)
+    - global: at most `global_rate` requests per second, and none at all while a global 429 lasts
+
+    Example
+    -------
+    >>> await limiter.acquire("PATCH /guilds/{guild_id}/members/{user_id}", major=guild_id)
+    >>> response = ...
+    >>> limiter.update("PATCH /guilds/{guild_id}/members/{user_id}", guild_id, response.headers, response.status_code, response.json())
+
+    """
+    def __init__(self, global_rate: int = 50, max_wait: Optional[float] = 5, probe_timeout: float = 10, sweep_interval: float = 60, debug: bool = False):
+        self.global_rate = global_rate
+        self.max_wait = max_wait # default for acquire(), None to wait as long as needed
+        self.probe_timeout = probe_timeout # seconds to wait for the probe of an unknown bucket, in case it never gets a response
+        self.sweep_interval = sweep_interval # seconds between two removals of the idle buckets
+        self.debug = debug
+        self._route_buckets: Dict[str, str] = {} # route => Discord bucket hash (routes can share a bucket)
+        self._buckets: Dict[Tuple[str, Hashable], RateLimitBucket] = {} # (bucket hash or route, major) => bucket
+        self._next_sweep = monotonic() + sweep_interval
+        self._global_lock = asyncio.Lock()
+        self._global_window: Deque[float] = deque() # start times of the requests of the last second
+        self._global_blocked_until: float = 0
+        self.stats = {"requests": 0, "delayed": 0, "delay_s": 0.0, "rate_limited": 0, "global_rate_limited": 0, "buckets": 0}
+
+    def _bucket(self, route: str, major: Hashable) -> RateLimitBucket:
+        key = (self._route_buckets.get(route, route), major)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._sweep()
+            bucket = self._buckets[key] = RateLimitBucket()
+            self.stats["buckets"] = len(self._buckets)
+        return bucket
+
+    def _sweep(self):
+        """
+        Removes the buckets past their reset time and not in use: majors are often user tokens,
+        one bucket per user would otherwise be kept forever. A removed bucket is learnt again on its next request.
+        """
+        now = monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        idle = [key for key, bucket in self._buckets.items() if bucket.reset_at <= now and bucket.probe is None and not bucket.lock.locked()]
+        for key in idle:
+            del self._buckets[key]
+        if self.debug and idle:
+            logger.debug(f"{len(idle)} idle rate limit buckets removed, {len(self._buckets)} left")
+
+    async def _sleep(self, route: str, delay: float, deadline: Optional[float]):
+        if deadline is not None and monotonic() + delay > deadline:
+            raise RateLimitTimeout(route, delay)
+        if self.debug:
+            logger.debug(f"{route}: waiting {delay:.2f}s for the rate limit")
+        self.stats["delayed"] += 1
+        self.stats["delay_s"] += delay
+        await asyncio.sleep(delay)
+
+    async def acquire(self, route: str, major: Hashable = None, max_wait: Any = ...):
+        """
+        Waits until a request to `route` fits in its bucket and in the global budget, and reserves it.
+        Raises `RateLimitTimeout` instead of waiting more than `max_wait` seconds (defaults to `self.max_wait`),
+        in total: behind the other requests of the bucket, for the probe of an unknown bucket and for the budgets.
+        The request must then be followed by `update()` with its response, or `cancel()` if there is none.
+        """
+        max_wait = self.max_wait if max_wait is ... else max_wait
+        deadline = None if max_wait is None else monotonic() + max_wait
+        bucket, probe = None, None
+        try:
+            async with asyncio.timeout(max_wait):
+                while True:
+                    bucket = self._bucket(route, major)
+                    async with bucket.lock: # requests of a bucket leave in order
+                        if bucket.remaining is None and bucket.probe is not None:
+                            try:
+                                await asyncio.wait_for(bucket.probe.wait(), self.probe_timeout)
+                            except asyncio.TimeoutError:
+                                bucket.end_probe()
+                        if self._bucket(route, major) is not bucket:
+                            continue # the route was mapped to its Discord bucket meanwhile, or the bucket was removed
+                        delay = bucket.delay(monotonic())
+                        if delay > 0:
+                            await self._sleep(route, delay, deadline)
+                            bucket.delay(monotonic())
+                        if bucket.remaining is None and not bucket.unlimited: # unknown, or just reset
+                            probe = bucket.probe = asyncio.Event()
+                        if bucket.remaining is not None:
+                            bucket.remaining -= 1
+                        break
+                async with self._global_lock:
+                    now = monotonic()
+                    while self._global_window and self._global_window[0] <= now - 1:
+                        self._global_window.popleft()
+                    delay = self._global_blocked_until - now
+                    if len(self._global_window) >= self.global_rate:
+                        delay = max(delay, self._global_window[0] + 1 - now)
+                    if delay > 0:
+                        await self._sleep(route, delay, deadline)
+                    self._global_window.append(monotonic())
+        except BaseException as e:
+            if probe is not None and bucket.probe is probe:
+                bucket.end_probe() # not sent, the requests waiting for this probe go on
+            if isinstance(e, TimeoutError):
+                raise RateLimitTimeout(route, max_wait) from e
+            raise
+        self.stats["requests"] += 1
+
+    def cancel(self, route: str, major: Hashable = None):
+        """
+        To call when a request reserved by `acquire()` got no response (network error, cancellation...),
+        or one without rate limit information (disnake doesn't expose the headers of its successful responses):
+        what is known of the bucket is kept, unlike `update()` with no headers, which marks the route `unlimited`.
+        """
+        self._bucket(route, major).end_probe()
+
+    def update(self, route: str, major: Hashable, headers: Mapping[str, str], status: int = 200, body: Any = None) -> float:
+        """
+        Learns the bucket state from the headers of a response to `route`, and the 429s.
+        Returns the seconds to wait before retrying if it was a 429, else 0.
+        """
+        bucket_hash = headers.get("X-RateLimit-Bucket")
+        bucket = self._bucket(route, major)
+        if bucket_hash and self._route_buckets.get(route) != bucket_hash:
+            self._route_buckets[route] = bucket_hash
+            bucket.end_probe() # the next requests wait on the real bucket
+            bucket = self._bucket(route, major)
+        now = monotonic()
+        remaining, reset_after = headers.get("X-RateLimit-Remaining"), headers.get("X-RateLimit-Reset-After")
+        if remaining is not None and reset_after is not None:
+            bucket.remaining = int(remaining)
+            bucket.reset_at = now + float(reset_after)
+        bucket.unlimited = remaining is None and status != 429
+        bucket.end_probe()
+        if status != 429:
+            return 0
+
+        body = body if isinstance(body, dict) else {}
+        retry_after = float(body.get("retry_after") or headers.get("Retry-After") or 1)
+        if body.get("global") or headers.get("X-RateLimit-Global") or headers.get("X-RateLimit-Scope") == "global":
+            self.stats["global_rate_limited"] += 1
+            self._global_blocked_until = max(self._global_blocked_until, now + retry_after)
+            logger.warning(f"{route}: global Discord rate limit hit, blocking all requests for {retry_after:.2f}s")
+        else:
+            self.stats["rate_limited"] += 1
+            bucket.remaining = 0
+            bucket.reset_at = max(bucket.reset_at, now + retry_after)
+            logger.warning(f"{route}: Discord rate limit hit (bucket {bucket_hash or route}), retry after {retry_after:.2f}s")
+        return retry_after
@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from time import time
+from typing import Any, Callable, Dict, Literal, Optional, Sequence, Tuple
+import binascii
+import json
+import logging
+import secrets
+import sqlite3
+
+import anyio
+import anyio.to_thread
+import itsdangerous
+import msgpack
+from itsdangerous.exc import BadSignature
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils import TTLCache
+
+logger = logging.getLogger("sessions")
+
+
+class SessionIndex:
+    """
+    Index of the sessions created by a CAS login, for CAS Single Logout (SLO).
+
+    Maps the CAS service ticket of each login to the session ID (`session["sid"]`) it created, so a back-channel
+    logout request (which only carries the ticket) invalidates the matching session with dict lookups,
+    without scanning session storage. A server-side session is deleted from its backend right away (`logout()`
+    returns its store ID), a cookie session (SESSION_BACKEND="cookie") can't be: invalidated session IDs are remembered
+    until the sessions expire and cleared by `SessionRevocationMiddleware` on their next request.
+    """
+    def __init__(self, ttl: float, maxsize: int = 100_000):
+        self._sessions = TTLCache(ttl=ttl, maxsize=maxsize) # service ticket => (session id, server-side session store id)
+        self._revoked = TTLCache(ttl=ttl, maxsize=maxsize) # session id => True
+
+    def add(self, ticket: str, sid: str, store_id: Optional[str] = None):
+        self._sessions.set(ticket, (sid, store_id))
+
+    def logout(self, ticket: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Invalidates the session created with this service ticket,
+        returns its session ID and its server-side store ID (to delete it right away) if there was one
+        """
+        sid, store_id = self._sessions.pop(ticket, (None, None))
+        if sid is not None:
+            self._revoked.set(sid, True)
+        return sid, store_id
+
+    def is_revoked(self, sid: Optional[str]) -> bool:
+        return sid is not None and self._revoked.get(sid, False)
+
+
+class SessionRevocationMiddleware:
+    """
+    Clears sessions invalidated by CAS Single Logout, must be added before (inside) the session middleware
+    """
+    def __init__(self, app: ASGIApp, index: SessionIndex):
+        self.app = app
+        self.index = index
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            session = scope.get("session")
+            if session and self.index.is_revoked(session.get("sid")):
+                logger.info(f"Clearing session {session.get('sid')} logged out by CAS")
+                session.clear()
+        await self.app(scope, receive, send)
+
+
+# ---------------- server-side sessions ----------------
+
+class SessionBackend:
+    """
+    Server-side session storage: session store ID => JSON serialized session data, until its expiry (epoch time)
+    """
+    async def load(self, store_id: str) -> Optional[Tuple[str, float]]:
+        """ (data, expires_at) of the session, None if it doesn't exist or has expired """
+        raise NotImplementedError
+
+    async def save(self, store_id: str, data: str, max_age: float):
+        raise NotImplementedError
+
+    async def delete(self, store_id: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemorySessionBackend(SessionBackend):
+    """
+    In-memory LRU session store, the least recently used sessions are evicted beyond `maxsize` sessions.
+    Sessions don't survive a restart, see `SQLiteSessionBackend`.
+    """
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict() # store id => (data, expires_at)
+
+    async def load(self, store_id: str) -> Optional[Tuple[str, float]]:
+        item = self._data.get(store_id)
+        if item is None:
+            return None
+        if item[1] < time():
+            del self._data[store_id]
+            return None
+        self._data.move_to_end(store_id)
+        return item
+
+    async def save(self, store_id: str, data: str, max_age: float):
+        self._data[store_id] = (data, time() + max_age)
+        self._data.move_to_end(store_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, store_id: str):
+        self._data.pop(store_id, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    SQLite file session store (sessions survive restarts), queries run one at a time in a worker thread.
+    Expired sessions are purged every `purge_every` saves.
+    """
+    def __init__(self, path: str = "sessions.db", purge_every: int = 1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._saves = 0
+        self._limiter = anyio.CapacityLimiter(1) # one sqlite3 connection, one query at a time
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None) # autocommit
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    async def _run(self, query: str, params: Sequence = ()) -> list:
+        return await anyio.to_thread.run_sync(lambda: self._db.execute(query, params).fetchall(), limiter=self._limiter)
+
+    async def load(self, store_id: str) -> Optional[Tuple[str, float]]:
+        rows = await self._run("SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at >= ?", (store_id, time()))
+        return rows[0] if rows else None
+
+    async def save(self, store_id: str, data: str, max_age: float):
+        await self._run("INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)", (store_id, data, time() + max_age))
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            await self._run("DELETE FROM sessions WHERE expires_at < ?", (time(),))
+
+    async def delete(self, store_id: str):
+        await self._run("DELETE FROM sessions WHERE id = ?", (store_id,))
+
+    async def close(self):
+        await anyio.to_thread.run_sync(self._db.close, limiter=self._limiter)
+
+
+class ServerSessionMiddleware:
+    """
+    Drop-in replacement of Starlette's `SessionMiddleware` keeping the sessions server-side in `backend`:
+    the cookie only carries an opaque random session store ID (no payload to decode and verify on each request).
+
+    - paths starting with one of `exclude_paths` (static files) get no session at all (no lookup, no cookie)
+    - an empty session is never stored: keep what anonymous visitors need out of the session (e.g. the language
+      is a plain cookie), or every crawler request would create a stored session
+    - a session is only written back when its content changed, or when it is past half of its `max_age`
+      (sliding expiry without one write per request)
+    - a cleared session is deleted from the backend and its cookie expired
+    - `regenerate_session_id()` gives the session a new store ID (on login, against session fixation)
+    """
+    STORE_ID_LENGTH = 43 # secrets.token_urlsafe(32)
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        backend: SessionBackend,
+        session_cookie: str = "session",
+        max_age: int = 14 * 24 * 60 * 60,
+        path: str = "/",
+        same_site: Literal["lax", "strict", "none"] = "lax",
+        https_only: bool = False,
+        exclude_paths: Sequence[str] = ("/static",),
+    ):
+        self.app = app
+        self.backend = backend
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.path = path
+        self.exclude_paths = tuple(exclude_paths)
+        self.security_flags = "httponly; samesite=" + same_site
+        if https_only: # Secure flag can be used with HTTPS only
+            self.security_flags += "; secure"
+
+    def _store_id(self, scope: Scope) -> Optional[str]:
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                store_id = cookie_parser(value.decode("latin-1")).get(self.session_cookie)
+                if store_id is not None and len(store_id) == self.STORE_ID_LENGTH:
+                    return store_id
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] not in ("http", "websocket") or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+
+        store_id = self._store_id(scope)
+        stored = await self.backend.load(store_id) if store_id is not None else None
+        if stored is None:
+            initial_data, expires_at = None, 0
+            scope["session"] = {}
+        else:
+            initial_data, expires_at = stored
+            scope["session"] = json.loads(initial_data)
+        scope["session_store_id"] = store_id if stored is not None else secrets.token_urlsafe(32)
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                session = scope["session"]
+                previous_store_id = scope.get("session_previous_store_id")
+                if previous_store_id:
+                    await self.backend.delete(previous_store_id)
+                if session:
+                    data = json.dumps(session, separators=(",", ":"))
+                    if previous_store_id or data != initial_data or expires_at - time() < self.max_age / 2:
+                        await self.backend.save(scope["session_store_id"], data, self.max_age)
+                        self._set_cookie(message, scope["session_store_id"], f"Max-Age={self.max_age}; ")
+                elif initial_data is not None:
+                    # the session has been cleared
+                    await self.backend.delete(scope["session_store_id"])
+                    self._set_cookie(message, "null", "expires=Thu, 01 Jan 1970 00:00:00 GMT; ")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _set_cookie(self, message: Message, value: str, expiry: str):
+        MutableHeaders(scope=message).append(
+            "Set-Cookie",
+            f"{self.session_cookie}={value}; path={self.path}; {expiry}{self.security_flags}",
+        )
+
+
+def regenerate_session_id(scope: Scope) -> Optional[str]:
+    """
+    Moves the server-side session to a new store ID (the previous one is deleted with the response),
+    returns the new ID, or None with cookie sessions (`SessionMiddleware`)
+    """
+    if "session_store_id" not in scope:
+        return None
+    scope.setdefault("session_previous_store_id", scope["session_store_id"])
+    scope["session_store_id"] = secrets.token_urlsafe(32)
+    return scope["session_store_id"]
+
+
+# ---------------- compact cookie sessions ----------------
+
+def _token_to_bytes(value: Any) -> Any:
+    # secrets.token_urlsafe() strings as their raw bytes (3/4 of the size), other values kept as is
+    if not isinstance(value, str):
+        return value
+    try:
+        raw = urlsafe_b64decode(value + "=" * (-len(value) % 4))
+    except (binascii.Error, ValueError):
+        return value
+    return raw if _bytes_to_token(raw) == value else value
+
+
+def _bytes_to_token(value: Any) -> Any:
+    return urlsafe_b64encode(value).rstrip(b"=").decode() if isinstance(value, bytes) else value
+
+
+def _id_to_int(value: Any) -> Any:
+    return int(value) if isinstance(value, str) and value.isdigit() else value
+
+
+def _int_to_id(value: Any) -> Any:
+    return str(value) if isinstance(value, int) else value
+
+
+def _as_list(value: Any) -> Any:
+    # packed user (AttributeProjection.pack), other values (the legacy dict user) kept as is
+    return list(value) if isinstance(value, tuple) else value
+
+
+class SessionCodec:
+    """
+    Compact binary (msgpack) encoding of the session: known keys are replaced by short tags,
+    Discord IDs (strings of digits in the API) are stored as integers and random tokens as raw bytes.
+    Unknown keys are stored as is, so any session round-trips.
+    """
+    # key => (tag, encode, decode)
+    FIELDS: Dict[str, Tuple[str, Callable, Callable]] = {
+        "lang": ("l", str, str),
+        "user": ("u", _as_list, _as_list),
+        "sid": ("s", _token_to_bytes, _bytes_to_token),
+        "discord_token": ("t", str, str),
+        "discord_refresh_token": ("r", str, str),
+        "discord_token_expires_at": ("e", int, float), # to the second
+        "discord_username": ("n", str, str),
+        "discord_global_name": ("g", str, str),
+        "discord_id": ("i", _id_to_int, _int_to_id),
+        "discord_guilds": ("G", list, list), # ints already
+    }
+
+    def __init__(self):
+        self._decoders = {tag: (key, decode) for key, (tag, _, decode) in self.FIELDS.items()}
+
+    def encode_fields(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        encoded = {}
+        for key, value in session.items():
+            field = self.FIELDS.get(key)
+            if field is None or value is None:
+                encoded[key if field is None else field[0]] = value
+            else:
+                encoded[field[0]] = field[1](value)
+        return encoded
+
+    def encode(self, session: Dict[str, Any]) -> bytes:
+        return msgpack.packb(self.encode_fields(session), use_bin_type=True)
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        encoded = msgpack.unpackb(data, raw=False, strict_map_key=False)
+        if not isinstance(encoded, dict):
+            raise ValueError("not a session")
+        session = {}
+        for tag, value in encoded.items():
+            key, decode = self._decoders.get(tag, (tag, None))
+            session[key] = decode(value) if decode is not None and value is not None else value
+        return session
+
+    def sizes(self, session: Dict[str, Any]) -> Dict[str, int]:
+        """ encoded bytes of each key, to find what makes a session too big """
+        return {key: len(self.encode({key: value})) for key, value in session.items()}
+
+
+class CompactSessionMiddleware:
+    """
+    Drop-in replacement of Starlette's `SessionMiddleware` (same signed cookie, same options)
+    with the compact `SessionCodec` encoding instead of JSON, and a hard `max_bytes` budget for the cookie:
+    a session that would exceed it first loses its `shed_keys` (data that can be fetched again), and if it is
+    still too big its cookie is not updated. Both are logged with the size of the offending keys.
+    Cookies in Starlette's JSON format are still read, so switching doesn't log anyone out.
+    """
+    def __init__(
+        self,
+        app: ASGIApp,
+        secret_key: str,
+        session_cookie: str = "session",
+        max_age: Optional[int] = 14 * 24 * 60 * 60,
+        path: str = "/",
+        same_site: Literal["lax", "strict", "none"] = "lax",
+        https_only: bool = False,
+        domain: Optional[str] = None,
+        max_bytes: int = 4000, # browsers drop cookies over 4096 bytes (name, value and attributes)
+        shed_keys: Sequence[str] = ("discord_guilds",),
+        codec: Optional[SessionCodec] = None,
+    ):
+        self.app = app
+        self.signer = itsdangerous.TimestampSigner(str(secret_key))
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.path = path
+        self.max_bytes = max_bytes
+        self.shed_keys = tuple(shed_keys)
+        self.codec = codec if codec is not None else SessionCodec()
+        self.security_flags = "httponly; samesite=" + same_site
+        if https_only: # Secure flag can be used with HTTPS only
+            self.security_flags += "; secure"
+        if domain is not None:
+            self.security_flags += f"; domain={domain}"
+
+    def _load(self, cookie: str) -> Optional[Dict[str, Any]]:
+        try:
+            data = self.signer.unsign(cookie.encode("utf-8"), max_age=self.max_age)
+        except BadSignature:
+            return None
+        try:
+            return self.codec.decode(urlsafe_b64decode(data + b"=" * (-len(data) % 4)))
+        except (ValueError, msgpack.UnpackException, binascii.Error):
+            pass
+        try:
+            return json.loads(b64decode(data)) # Starlette SessionMiddleware cookie
+        except (ValueError, binascii.Error):
+            return None
+
+    def _dump(self, session: Dict[str, Any]) -> Optional[str]:
+        value = self.signer.sign(urlsafe_b64encode(self.codec.encode(session)).rstrip(b"=")).decode("utf-8")
+        if len(value) <= self.max_bytes:
+            return value
+        sizes = self.codec.sizes(session)
+        shed = [key for key in self.shed_keys if key in session]
+        logger.warning(f"Session cookie of {len(value)} bytes over the {self.max_bytes} bytes budget, dropping {shed}, key sizes: {sizes}")
+        for key in shed:
+            session.pop(key)
+        value = self.signer.sign(urlsafe_b64encode(self.codec.encode(session)).rstrip(b"=")).decode("utf-8")
+        if len(value) <= self.max_bytes:
+            return value
+        logger.error(f"Session cookie of {len(value)} bytes still over the {self.max_bytes} bytes budget, not saved, key sizes: {sizes}")
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        session = None
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                cookie = cookie_parser(value.decode("latin-1")).get(self.session_cookie)
+                if cookie:
+                    session = self._load(cookie)
+                break
+        initial_session_was_empty = not session
+        scope["session"] = session or {}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                if scope["session"]:
+                    value = self._dump(scope["session"])
+                    if value is not None:
+                        self._set_cookie(message, value, f"Max-Age={self.max_age}; " if self.max_age else "")
+                elif not initial_session_was_empty:
+                    # the session has been cleared
+                    self._set_cookie(message, "null", "expires=Thu, 01 Jan 1970 00:00:00 GMT; ")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _set_cookie(self, message: Message, value: str, expiry: str):
+        MutableHeaders(scope=message).append(
+            "Set-Cookie",
+            f"{self.session_cookie}={value}; path={self.path}; {expiry}{self.security_flags}",
+        )
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Static assets build: content hashed file names, gzip and brotli variants and their manifest,
+# served by PrecompressedStaticFiles and linked with the static_url() Jinja global.
+#
+# Usage: python src/static_assets.py [source_dir] [output_dir]    (default: src/static build/static)
+import gzip
+import json
+import logging
+import mimetypes
+import shutil
+import sys
+from hashlib import sha256
+from os import makedirs, path, stat, walk
+from typing import Dict, List, Optional
+
+from jinja2 import pass_context
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from utils import accepted_encodings
+
+try:
+    import brotli
+except ImportError: # optional, only gzip variants without it
+    brotli = None
+
+logger = logging.getLogger("static")
+
+MANIFEST_FILE = "manifest.json"
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".ico", ".json", ".txt", ".html", ".xml", ".map"} # images are already compressed
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"} # by preference order
+
+
+def hashed_name(name: str, content: bytes) -> str:
+    root, extension = path.splitext(name)
+    return f"{root}.{sha256(content).hexdigest()[:10]}{extension}"
+
+
+def build(source: str = "src/static", output: str = "build/static") -> Dict[str, Dict]:
+    """
+    Copies the files of `source` to `output` under their name and a content hashed name ("style.3f2a1b9c04.css"),
+    with .gz and .br (if the brotli package is installed) variants of the text files, when smaller.
+    Writes and returns the manifest: {"files": {name: hashed name}, "encodings": {file: ["br", "gzip"]}}.
+    """
+    if path.realpath(source) == path.realpath(output):
+        raise ValueError("The output directory must not be the source directory")
+    if path.exists(output):
+        shutil.rmtree(output)
+    manifest = {"files": {}, "encodings": {}}
+    for root, _, files in walk(source):
+        for file in sorted(files):
+            name = path.relpath(path.join(root, file), source).replace(path.sep, "/")
+            with open(path.join(root, file), "rb") as source_file:
+                content = source_file.read()
+            hashed = hashed_name(name, content)
+            manifest["files"][name] = hashed
+            variants = {}
+            if path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                if brotli is not None:
+                    variants["br"] = brotli.compress(content, quality=11)
+                variants["gzip"] = gzip.compress(content, compresslevel=9, mtime=0)
+                variants = {encoding: body for encoding, body in variants.items() if len(body) < len(content)}
+            for target in (name, hashed):
+                makedirs(path.dirname(path.join(output, target)), exist_ok=True)
+                with open(path.join(output, target), "wb") as output_file:
+                    output_file.write(content)
+                for encoding, body in variants.items():
+                    with open(path.join(output, target) + ENCODING_SUFFIXES[encoding], "wb") as output_file:
+                        output_file.write(body)
+                if variants:
+                    manifest["encodings"][target] = list(variants)
+            logger.info(f"{name} => {hashed} ({len(content)} bytes{''.join(f', {encoding}: {len(body)}' for encoding, body in variants.items())})")
+    with open(path.join(output, MANIFEST_FILE), "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+class StaticManifest:
+    """
+    The manifest of a static build (`build()`), empty when the assets aren't built (e.g. in development):
+    `static_url()` then links the files under their own name.
+    """
+    def __init__(self, directory: Optional[str] = None, files: Optional[Dict[str, str]] = None, encodings: Optional[Dict[str, List[str]]] = None):
+        self.directory = directory
+        self.files = files or {} # name => hashed name
+        self.hashed = set(self.files.values())
+        self.encodings = encodings or {} # file => available encodings
+
+    @classmethod
+    def load(cls, directory: str) -> "StaticManifest":
+        try:
+            with open(path.join(directory, MANIFEST_FILE), "r", encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except FileNotFoundError:
+            logger.info(f"No static build in {directory} (python src/static_assets.py), serving the static files as is")
+            return cls()
+        logger.info(f"Static build loaded from {directory}: {len(manifest['files'])} files")
+        return cls(directory, manifest["files"], manifest["encodings"])
+
+    @pass_context
+    def static_url(self, context, name: str) -> str:
+        """
+        Jinja global: URL of the static file `name`, under its hashed name if it was built
+        """
+        return str(context["request"].url_for("static", path=self.files.get(name, name)))
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    `StaticFiles` serving the .br/.gz variants of a static build to the clients accepting them,
+    with `Cache-Control: immutable` for the content hashed files and `max_age` seconds for the others.
+    """
+    def __init__(self, *args, manifest: Optional[StaticManifest] = None, max_age: int = 3600, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest = manifest if manifest is not None else StaticManifest()
+        self.max_age = max_age
+        self.stats = {"requests": 0, **{encoding: 0 for encoding in ENCODING_SUFFIXES}}
+
+    def file_response(self, full_path, stat_result, scope: Scope, status_code: int = 200) -> Response:
+        self.stats["requests"] += 1
+        request_headers = Headers(scope=scope)
+        name = path.relpath(full_path, self.directory).replace(path.sep, "/") if self.directory else ""
+        headers = {
+            "Cache-Control": "public, max-age=31536000, immutable" if name in self.manifest.hashed else f"public, max-age={self.max_age}",
+        }
+        encodings = self.manifest.encodings.get(name)
+        if encodings:
+            headers["Vary"] = "Accept-Encoding"
+            accepted = accepted_encodings(request_headers.get("accept-encoding"))
+            for encoding in encodings:
+                if encoding in accepted:
+                    variant = str(full_path) + ENCODING_SUFFIXES[encoding]
+                    self.stats[encoding] += 1
+                    response = FileResponse(
+                        variant,
+                        status_code=status_code,
+                        stat_result=stat(variant),
+                        media_type=mimetypes.guess_type(str(full_path))[0] or "text/plain",
+                        headers={**headers, "Content-Encoding": encoding},
+                    )
+                    break
+            else:
+                response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        else:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="{name}:[{levelname}] {message}", style="{")
+    build(*sys.argv[1:3])
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import logging
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from fastapi_discord import RateLimited
+from fastapi_discord.exceptions import InvalidToken
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from discord_api import DiscordAPI, DiscordTokens
+
+logger = logging.getLogger("discord")
+
+
+class DiscordTokenRefresher:
+    """
+    Renews the Discord OAuth2 tokens of the sessions in the background, `margin` seconds before they expire,
+    so that the request path never pays for a refresh (nor for a new OAuth2 login once the access token expired).
+
+    Tokens are kept by session ID (`session["sid"]`). A session is only loaded and saved by the session middleware
+    of its own requests (server-side record or signed cookie), so renewed tokens are written back to the session
+    on its next request by `DiscordTokenSyncMiddleware`.
+    Every `interval` seconds, the due tokens are refreshed by batches of `batch_size` concurrent requests,
+    through the Discord rate limiter of `discord_api`. Rate limited refreshes are retried on the next round.
+    """
+    def __init__(self, discord_api: DiscordAPI, margin: float = 3600, interval: float = 60, batch_size: int = 10, ttl: float = 14 * 24 * 3600, debug: bool = False):
+        self.discord_api = discord_api
+        self.margin = margin
+        self.interval = interval
+        self.batch_size = batch_size
+        self.ttl = ttl # seconds a session's tokens are kept (the session max age)
+        self.debug = debug
+        self._tokens: Dict[str, Tuple[DiscordTokens, float, float]] = {} # sid => (tokens, due_at, forget_at)
+        self._due: List[Tuple[float, str]] = [] # heap of (due_at, sid), entries of forgotten/renewed tokens are skipped
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"refreshed": 0, "failed": 0, "expired": 0}
+
+    def add(self, sid: str, tokens: DiscordTokens, refresh_at: Optional[float] = None):
+        """
+        Keeps the tokens of session `sid`, to refresh at `refresh_at` (epoch time, defaults to `margin` seconds before they expire).
+        """
+        refresh_at = tokens.expires_at - self.margin if refresh_at is None else refresh_at
+        forget_at = self._tokens[sid][2] if sid in self._tokens else time() + self.ttl
+        due_at = min(refresh_at, forget_at)
+        self._tokens[sid] = (tokens, due_at, forget_at)
+        heapq.heappush(self._due, (due_at, sid))
+
+    def get(self, sid: Optional[str]) -> Optional[DiscordTokens]:
+        item = self._tokens.get(sid) if sid is not None else None
+        return item[0] if item is not None else None
+
+    def forget(self, sid: Optional[str]):
+        if sid is not None:
+            self._tokens.pop(sid, None)
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                logger.error(f"Discord token refresh round failed: {e!r}")
+
+    def _pop_due(self) -> List[Tuple[str, DiscordTokens]]:
+        now = time()
+        due = []
+        while self._due and self._due[0][0] <= now:
+            due_at, sid = heapq.heappop(self._due)
+            item = self._tokens.get(sid)
+            if item is None or item[1] != due_at:
+                continue # forgotten or renewed since
+            tokens, _, forget_at = item
+            if forget_at <= now:
+                del self._tokens[sid] # the session has expired
+                continue
+            due.append((sid, tokens))
+        return due
+
+    async def refresh_due(self):
+        due = self._pop_due()
+        if not due:
+            return
+        retry_at = time() + self.interval
+        for start in range(0, len(due), self.batch_size):
+            results = await asyncio.gather(
+                *(self.discord_api.refresh_access_token(tokens.refresh_token) for _, tokens in due[start:start + self.batch_size]),
+                return_exceptions=True,
+            )
+            for (sid, tokens), result in zip(due[start:start + self.batch_size], results):
+                if sid not in self._tokens:
+                    continue # logged out meanwhile
+                if isinstance(result, DiscordTokens):
+                    self.stats["refreshed"] += 1
+                    self.add(sid, result)
+                elif isinstance(result, InvalidToken):
+                    # refresh token revoked or already used: the user will have to log in with Discord again,
+                    # the tokens are kept (not refreshed) so that DiscordTokenSyncMiddleware doesn't add them back
+                    self.stats["expired"] += 1
+                    self.add(sid, tokens, refresh_at=float("inf"))
+                else:
+                    self.stats["failed"] += 1
+                    if not isinstance(result, RateLimited):
+                        logger.warning(f"Discord token refresh failed for session {sid}: {result!r}")
+                    self.add(sid, tokens, refresh_at=retry_at)
+        logger.info(f"Discord token refresh: {len(due)} due, {self.stats}")
+
+
+class DiscordTokenSyncMiddleware:
+    """
+    Writes the tokens renewed by `DiscordTokenRefresher` back to the session (no network call),
+    and registers the tokens of the sessions it doesn't know yet (e.g. after a restart).
+    Must be added before (inside) the session middleware.
+    """
+    def __init__(self, app: ASGIApp, refresher: DiscordTokenRefresher):
+        self.app = app
+        self.refresher = refresher
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            session = scope.get("session")
+            if session and session.get("discord_token"):
+                sid = session.get("sid")
+                tokens = self.refresher.get(sid)
+                if tokens is None:
+                    if sid is not None and session.get("discord_refresh_token"):
+                        self.refresher.add(sid, DiscordTokens(session["discord_token"], session["discord_refresh_token"], session.get("discord_token_expires_at", 0)))
+                elif tokens.access_token != session["discord_token"]:
+                    session["discord_token"] = tokens.access_token
+                    session["discord_refresh_token"] = tokens.refresh_token
+                    session["discord_token_expires_at"] = tokens.expires_at
+        await self.app(scope, receive, send)
@@ -1,4 +1,10 @@
 import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+from jinja2 import Environment
 
 def addLoggingLevel(levelName: str, levelNum: int, methodName: str = None):
     """
@@ -49,3 +55,155 @@ def addLoggingLevel(levelName: str, levelNum: int, methodName: str = None):
     setattr(logging, levelName, levelNum)
     setattr(logging.getLoggerClass(), methodName, logForLevel)
     setattr(logging, methodName, logToRoot)
+
+
+def precompile_templates(env: Environment, extensions: Tuple[str, ...] = ("jinja", "html")) -> Tuple[int, float, List[str]]:
+    """
+    Compiles every template of `env` (or loads it from its bytecode cache) so that the first requests
+    after a (re)start don't pay for it.
+    Returns the number of templates compiled, the duration in milliseconds and the names of the ones that failed.
+    """
+    start = perf_counter()
+    compiled, failed = 0, []
+    for name in env.list_templates(extensions=extensions):
+        try:
+            env.get_template(name)
+            compiled += 1
+        except Exception as e:
+            logging.getLogger("app").error(f"Template {name} doesn't compile: {e!r}")
+            failed.append(name)
+    return compiled, (perf_counter() - start) * 1000, failed
+
+
+def accepted_encodings(header: Optional[str]) -> Set[str]:
+    """
+    Content codings accepted by an Accept-Encoding header ("br;q=1.0, gzip;q=0.8, *;q=0.1"), the ones with q=0 excluded.
+    """
+    encodings = set()
+    for item in (header or "").split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            encodings.add(coding)
+    return encodings
+
+
+class Timer:
+    """
+    Collects named durations (in milliseconds) of the steps of a request,
+    for logging and for the `Server-Timing` response header.
+
+    Example
+    -------
+    >>> timer = Timer()
+    >>> with timer("cas"):
+    ...     await cas_client.validate(ticket)
+    >>> response.headers["Server-Timing"] = timer.header()
+
+    """
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (perf_counter() - start) * 1000
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in self.timings.items())
+
+    def __str__(self) -> str:
+        return ", ".join(f"{name}={duration:.1f}ms" for name, duration in self.timings.items())
+
+
+class TTLCache:
+    """
+    Small in-memory cache whose entries expire `ttl` seconds after being set (or after their own `ttl`),
+    the oldest entries are evicted once it holds more than `maxsize` entries.
+    """
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict() # key => (expires_at, value)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] < monotonic():
+            del self._data[key]
+            return default
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class PoolStats:
+    """
+    Connection pool metrics of an `httpx.AsyncClient`: requests sent, new connections (TCP connects
+    and TLS handshakes) and the resulting connection reuse rate, from httpcore's trace extension.
+
+    Example
+    -------
+    >>> stats = PoolStats()
+    >>> client = AsyncClient(event_hooks={"request": [stats.on_request], "response": [stats.on_response]})
+
+    """
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.http_versions: Dict[str, int] = {}
+
+    async def on_request(self, request):
+        self.requests += 1
+        request.extensions["trace"] = self.trace
+
+    async def on_response(self, response):
+        self.http_versions[response.http_version] = self.http_versions.get(response.http_version, 0) + 1
+
+    async def trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections += 1
+        elif event_name == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+
+    @property
+    def reuse_rate(self) -> float:
+        if not self.requests:
+            return 0
+        return max(0, 1 - self.connections / self.requests)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "tls_handshakes": self.tls_handshakes,
+            "reuse_rate": round(self.reuse_rate, 3),
+            "http_versions": self.http_versions,
+        }
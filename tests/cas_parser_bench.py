@@ -0,0 +1,72 @@
+# Micro-benchmark of the CAS validation response parser (src/cas_auth.py)
+# against the previous ElementTree implementation (old/CASAuth.py), over recorded CAS 1/2/3 responses.
+#
+# Usage: python tests/cas_parser_bench.py [number_of_iterations]
+
+import sys
+from os import listdir, path
+from timeit import timeit
+import json
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, path.join(path.dirname(__file__), "../src"))
+
+from cas_auth import CASResponseParser, CasRejectError
+
+FIXTURES_PATH = path.join(path.dirname(__file__), "fixtures/cas/")
+XML_NAMESPACES = {"cas": "http://www.yale.edu/tp/cas"}
+
+
+def legacy_parse_response(xml):
+    # old/CASAuth.py `_parse_response`: one namespaced find() per attribute + findall() in debug mode
+    tree = ET.fromstring(xml)
+    success = tree.find("./cas:authenticationSuccess", namespaces=XML_NAMESPACES)
+    if success is None:
+        tree.find("./cas:authenticationFailure", namespaces=XML_NAMESPACES)
+        return None
+    netid = success.find("cas:user", namespaces=XML_NAMESPACES).text
+    first_name_node = success.find("./cas:attributes/cas:givenName", namespaces=XML_NAMESPACES)
+    last_name_node = success.find("./cas:attributes/cas:sn", namespaces=XML_NAMESPACES)
+    for name in ("supannRefId", "cn", "supannRoleEntite"): # only logged in debug mode
+        success.find(f"./cas:attributes/cas:{name}", namespaces=XML_NAMESPACES)
+    email_node = success.find("./cas:attributes/cas:mail", namespaces=XML_NAMESPACES)
+    all_attributes = success.findall("./cas:attributes/*", namespaces=XML_NAMESPACES)
+    return {
+        "netid": netid,
+        "email": email_node.text if email_node is not None else f"{netid}@ulb.ac.be",
+        "first_name": first_name_node.text if first_name_node is not None else netid,
+        "last_name": last_name_node.text if last_name_node is not None else netid,
+        "attributes": {attr.tag: attr.text for attr in all_attributes},
+    }
+
+
+def parse(parser, name, content):
+    try:
+        if name.startswith("v1"):
+            return parser.parse_v1(content)
+        return parser.parse(content)
+    except CasRejectError:
+        return None
+
+
+def main(number: int = 20000):
+    example_filter = path.join(path.dirname(__file__), "../config/cas_attributes_filter.json.example")
+    with open(example_filter, "r", encoding="utf-8") as f:
+        attributes_filter = json.load(f).keys()
+    parser = CASResponseParser(attributes_filter)
+
+    print(f"attributes filter: {sorted(attributes_filter)}, {number} iterations per fixture")
+    print(f"{'fixture':<20} {'legacy (us)':>12} {'parser (us)':>12} {'speedup':>8}")
+    for name in sorted(f for f in listdir(FIXTURES_PATH) if f.startswith("v")):
+        with open(path.join(FIXTURES_PATH, name), "rb") as f:
+            content = f.read()
+        new = timeit(lambda: parse(parser, name, content), number=number) / number * 1e6
+        if name.startswith("v1"):
+            print(f"{name:<20} {'-':>12} {new:>12.2f} {'-':>8}")
+            continue
+        old = timeit(lambda: legacy_parse_response(content), number=number) / number * 1e6
+        print(f"{name:<20} {old:>12.2f} {new:>12.2f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,24 @@
+# pytest configuration: the modules of src/ are imported as top-level modules, like app.py does.
+# The other scripts of this directory (benchmarks, load test, bot) are run by hand, not collected.
+
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(__file__), "../src"))
+
+FIXTURES_PATH = path.join(path.dirname(__file__), "fixtures")
+
+collect_ignore = ["bot_tests.py", "login_load_test.py"]
+
+
+def read_fixture(name: str) -> bytes:
+    with open(path.join(FIXTURES_PATH, name), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def anyio_backend():
+    # async tests (marked `pytest.mark.anyio`) run on asyncio, like uvicorn
+    return "asyncio"
@@ -0,0 +1,155 @@
+# In-process stand-in for a CAS server, to test and load-test the login flow offline.
+# Implements /login, /validate (CAS 1), /serviceValidate, /proxyValidate (CAS 2), /p3/serviceValidate,
+# /p3/proxyValidate (CAS 3), /proxy and /logout, with configurable latency and failure rate.
+#
+# In-process: httpx.ASGITransport(app=FakeCASServer().app), see tests/login_load_test.py
+# Standalone: python tests/fake_cas_server.py [--port 8001] [--latency 0.05] [--failure-rate 0.01]
+#             then set CAS_SERVER_URL="http://localhost:8001" in your .env
+
+from typing import Dict, Optional
+from urllib.parse import urlencode
+from html import escape
+import argparse
+import asyncio
+import itertools
+import random
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, RedirectResponse, Response
+from starlette.routing import Route
+
+CAS_RESPONSE = """<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+    {}
+</cas:serviceResponse>"""
+
+SUCCESS = """<cas:authenticationSuccess>
+        <cas:user>{user}</cas:user>
+        <cas:attributes>
+            <cas:cn>{cn}</cas:cn>
+            <cas:mail>{mail}</cas:mail>
+            <cas:supannRefId>{ref_id}</cas:supannRefId>
+            <cas:supannRoleEntite>[role={{SUPANN}}E10][type={{SUPANN}}S230][code=ULB-POLYTECH]</cas:supannRoleEntite>
+        </cas:attributes>{pgtiou}
+    </cas:authenticationSuccess>"""
+
+FAILURE = """<cas:authenticationFailure code="{code}">{message}</cas:authenticationFailure>"""
+
+
+class FakeCASServer:
+    """
+    Fake CAS server: tickets are single-use and bound to the service they were issued for, like a real CAS.
+
+    `latency`: seconds added to every validation/proxy call (plus up to `jitter` random seconds),
+    `failure_rate`: probability for these calls to answer a 500.
+    """
+    def __init__(self, latency: float = 0, jitter: float = 0, failure_rate: float = 0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.tickets: Dict[str, tuple] = {} # ticket => (user, service)
+        self.proxy_granting_tickets: Dict[str, str] = {} # pgt => user
+        self.counter = itertools.count(1)
+        self.stats = {"login": 0, "validate": 0, "proxy": 0, "logout": 0, "failures": 0}
+        self.app = Starlette(routes=[
+            Route("/login", self.login),
+            Route("/validate", self.validate_v1),
+            Route("/serviceValidate", self.validate),
+            Route("/proxyValidate", self.validate),
+            Route("/p3/serviceValidate", self.validate),
+            Route("/p3/proxyValidate", self.validate),
+            Route("/proxy", self.proxy),
+            Route("/logout", self.logout),
+        ])
+
+    def issue_ticket(self, user: str, service: str, prefix: str = "ST") -> str:
+        ticket = f"{prefix}-{next(self.counter)}-{self.random.getrandbits(64):016x}-fakecas"
+        self.tickets[ticket] = (user, service)
+        return ticket
+
+    async def _simulate(self) -> Optional[Response]:
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.stats["failures"] += 1
+            return PlainTextResponse("Internal Server Error", status_code=500)
+        return None
+
+    def _consume(self, request: Request) -> Optional[str]:
+        ticket = request.query_params.get("ticket", "")
+        issued = self.tickets.pop(ticket, None) # single-use
+        if issued is None or issued[1] != request.query_params.get("service"):
+            return None
+        return issued[0]
+
+    async def login(self, request: Request) -> Response:
+        # no login form: the user is logged in right away, as ?username=... or a generated user
+        self.stats["login"] += 1
+        service = request.query_params.get("service")
+        if not service:
+            return PlainTextResponse("Logged in to fake CAS")
+        user = request.query_params.get("username") or f"user{next(self.counter)}"
+        ticket = self.issue_ticket(user, service)
+        separator = "&" if "?" in service else "?"
+        return RedirectResponse(f"{service}{separator}{urlencode({'ticket': ticket})}", status_code=302)
+
+    async def validate_v1(self, request: Request) -> Response:
+        self.stats["validate"] += 1
+        if (failure := await self._simulate()) is not None:
+            return failure
+        user = self._consume(request)
+        return PlainTextResponse(f"yes\n{user}\n" if user else "no\n\n")
+
+    async def validate(self, request: Request) -> Response:
+        self.stats["validate"] += 1
+        if (failure := await self._simulate()) is not None:
+            return failure
+        ticket = request.query_params.get("ticket", "")
+        user = self._consume(request)
+        if user is None:
+            body = FAILURE.format(code="INVALID_TICKET", message=f"Ticket {escape(ticket)} not recognized")
+        else:
+            pgtiou = ""
+            if request.query_params.get("pgtUrl"):
+                # simplification: the IOU itself is accepted as proxy granting ticket by /proxy (no callback to pgtUrl)
+                iou = f"PGTIOU-{next(self.counter)}-fakecas"
+                self.proxy_granting_tickets[iou] = user
+                pgtiou = f"\n        <cas:proxyGrantingTicket>{iou}</cas:proxyGrantingTicket>"
+            number = next(self.counter)
+            body = SUCCESS.format(user=escape(user), cn=f"Fake User {number}", mail=f"{escape(user)}@ulb.be", ref_id=f"{number:09d}", pgtiou=pgtiou)
+        return Response(CAS_RESPONSE.format(body), media_type="application/xml")
+
+    async def proxy(self, request: Request) -> Response:
+        self.stats["proxy"] += 1
+        if (failure := await self._simulate()) is not None:
+            return failure
+        user = self.proxy_granting_tickets.get(request.query_params.get("pgt", ""))
+        target = request.query_params.get("targetService")
+        if user is None or not target:
+            body = '<cas:proxyFailure code="INVALID_TICKET">Unknown proxy granting ticket</cas:proxyFailure>'
+        else:
+            body = f"<cas:proxySuccess><cas:proxyTicket>{self.issue_ticket(user, target, prefix='PT')}</cas:proxyTicket></cas:proxySuccess>"
+        return Response(CAS_RESPONSE.format(body), media_type="application/xml")
+
+    async def logout(self, request: Request) -> Response:
+        self.stats["logout"] += 1
+        service = request.query_params.get("service") or request.query_params.get("url")
+        if service:
+            return RedirectResponse(service, status_code=302)
+        return PlainTextResponse("Logged out from fake CAS")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the fake CAS server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to each validation call")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many random seconds added to the latency")
+    parser.add_argument("--failure-rate", type=float, default=0, help="probability of a 500 on validation calls")
+    args = parser.parse_args()
+    server = FakeCASServer(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate)
+    uvicorn.run(server.app, host=args.host, port=args.port)
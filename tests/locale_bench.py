@@ -0,0 +1,63 @@
+# Benchmark of the page level translation cost of Locale.lang_str (src/locales.py): the legacy lookup
+# (eager nested .get() fallback to the default language) against the flattened per language catalogs,
+# for the lang_str() calls of each template (keys read from src/templates), in every language and an unsupported one.
+#
+# Usage: python tests/locale_bench.py [number_of_pages]
+
+from os import listdir, path
+from time import perf_counter
+import re
+import sys
+
+sys.path.insert(0, path.join(path.dirname(__file__), "../src"))
+
+from locales import DEFAULT_LANG, Locale
+
+TEMPLATES_PATH = path.join(path.dirname(__file__), "../src/templates")
+LANG_STR_CALL = re.compile(r"lang_str\(\s*[\"']([^\"']+)[\"']")
+
+
+def legacy_lang_str(languages: dict, string: str, user_lang: str) -> str:
+    # Locale.lang_str before the catalogs (self.languages was a plain attribute)
+    if user_lang not in languages.keys():
+        user_lang = DEFAULT_LANG
+    return languages[user_lang].get(string, languages[DEFAULT_LANG].get(string, string))
+
+
+def template_keys() -> dict:
+    keys = {}
+    for file in sorted(listdir(TEMPLATES_PATH)):
+        if file.endswith(".jinja"):
+            with open(path.join(TEMPLATES_PATH, file), "r", encoding="utf-8") as template:
+                keys[file] = LANG_STR_CALL.findall(template.read())
+    return {file: strings for file, strings in keys.items() if strings}
+
+
+def bench(function, keys: list, lang: str, number: int) -> float:
+    start = perf_counter()
+    for _ in range(number):
+        for key in keys:
+            function(key, lang)
+    return (perf_counter() - start) / number * 1e6
+
+
+def main(number: int = 100000):
+    locale = Locale()
+    pages = template_keys()
+    langs = locale.lang_list + ["xx"]
+    languages = locale.languages
+    for lang in langs:
+        for keys in pages.values():
+            for key in keys:
+                assert locale.lang_str(key, lang) == legacy_lang_str(locale.languages, key, lang), (key, lang)
+    print(f"{number} renders per page, us per page (lang_str calls only)")
+    print(f"{'template':<28} {'calls':>5} {'lang':>5} {'legacy':>9} {'catalogs':>9}")
+    for file, keys in pages.items():
+        for lang in langs:
+            legacy = bench(lambda string, user_lang: legacy_lang_str(languages, string, user_lang), keys, lang, number)
+            new = bench(locale.lang_str, keys, lang, number)
+            print(f"{file:<28} {len(keys):>5} {lang:>5} {legacy:>9.2f} {new:>9.2f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
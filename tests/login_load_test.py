@@ -0,0 +1,141 @@
+# End-to-end load test of the login flow, offline: drives the real FastAPI `app` through httpx.ASGITransport,
+# with tests/fake_cas_server.py standing in for the CAS server (no network, no Discord token needed).
+#
+# Each simulated user (own cookie jar) goes through:
+#   /{lang}/ -> /login -> fake CAS /login -> /login?ticket=... -> /{lang}/user -> /discord-login
+# and the latency (p50/p99) of each step and of the whole flow, and the throughput, are reported.
+#
+# Usage: python tests/login_load_test.py [--users 1000] [--concurrency 50] [--cas-latency 0.05] [--cas-failure-rate 0.01]
+
+from os import environ, path
+from statistics import mean, quantiles
+from time import perf_counter
+from typing import Dict, List
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+SRC_PATH = path.join(path.dirname(__file__), "../src")
+sys.path.insert(0, SRC_PATH)
+sys.path.insert(0, path.dirname(__file__))
+
+FAKE_CAS_URL = "http://fake-cas.test"
+APP_URL = "http://localhost:8000"
+
+environ["CAS_SERVER_URL"] = FAKE_CAS_URL
+environ.setdefault("CAS_VERSION", "3")
+environ.setdefault("APP_SECRET_KEY", "load-test")
+environ.setdefault("DISCORD_CLIENT_ID", "0")
+environ.setdefault("DISCORD_CLIENT_SECRET", "load-test")
+
+from httpx import ASGITransport, AsyncClient
+
+from fake_cas_server import FakeCASServer
+import app as webapp
+from cas_auth import AttributeProjection
+
+# step name => expected status codes
+STEPS = {
+    "index": (200,),
+    "login-redirect": (307,),
+    "cas-login": (302,),
+    "login-callback": (307,),
+    "user": (200,),
+    "discord-login": (307,),
+}
+
+
+class Results:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {step: [] for step in [*STEPS, "flow"]}
+        self.errors: Dict[str, int] = {step: 0 for step in [*STEPS, "flow"]}
+
+    def report(self, duration: float, users: int):
+        print(f"{'step':<16} {'count':>7} {'errors':>7} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for step, latencies in self.latencies.items():
+            if len(latencies) < 2:
+                print(f"{step:<16} {len(latencies):>7} {self.errors[step]:>7}")
+                continue
+            cuts = quantiles(latencies, n=100)
+            print(f"{step:<16} {len(latencies):>7} {self.errors[step]:>7} {mean(latencies):>9.2f} {cuts[49]:>9.2f} {cuts[98]:>9.2f}")
+        completed = len(self.latencies["flow"]) - self.errors["flow"]
+        print(f"{users} login flows in {duration:.2f}s: {completed / duration:.1f} successful flows/s, {self.errors['flow']} failed")
+
+
+async def login_flow(app_transport: ASGITransport, cas_transport: ASGITransport, lang: str, results: Results):
+    flow_ok = True
+    flow_start = perf_counter()
+    async with AsyncClient(transport=app_transport, base_url=APP_URL) as browser, AsyncClient(transport=cas_transport, base_url=FAKE_CAS_URL) as cas_browser:
+        async def step(name: str, client: AsyncClient, url: str):
+            nonlocal flow_ok
+            start = perf_counter()
+            response = await client.get(url)
+            results.latencies[name].append((perf_counter() - start) * 1000)
+            if response.status_code not in STEPS[name]:
+                results.errors[name] += 1
+                flow_ok = False
+            return response
+
+        await step("index", browser, f"/{lang}/")
+        response = await step("login-redirect", browser, "/login")
+        if flow_ok:
+            response = await step("cas-login", cas_browser, response.headers["location"])
+        if flow_ok:
+            response = await step("login-callback", browser, response.headers["location"])
+        if flow_ok:
+            await step("user", browser, f"/{lang}/user")
+            await step("discord-login", browser, "/discord-login")
+    results.latencies["flow"].append((perf_counter() - flow_start) * 1000)
+    if not flow_ok:
+        results.errors["flow"] += 1
+
+
+async def main(users: int, concurrency: int, cas_latency: float, cas_jitter: float, cas_failure_rate: float):
+    fake_cas = FakeCASServer(latency=cas_latency, jitter=cas_jitter, failure_rate=cas_failure_rate, seed=0)
+    app = webapp.app
+
+    # same as init(), without the logging setup
+    filter_path = path.join(SRC_PATH, "../config/cas_attributes_filter.json")
+    if not path.exists(filter_path):
+        filter_path += ".example"
+    with open(filter_path, "r", encoding="utf-8") as f:
+        app.cas_attr_filter = json.load(f)
+    app.cas_projection = AttributeProjection(app.cas_attr_filter.keys())
+    webapp.cas_client.set_attributes_filter(app.cas_projection.wanted)
+    await webapp.cas_client.init(transport=ASGITransport(app=fake_cas.app))
+
+    app_transport = ASGITransport(app=app)
+    cas_transport = ASGITransport(app=fake_cas.app)
+    results = Results()
+    pending = iter(range(users))
+
+    async def worker():
+        for i in pending:
+            await login_flow(app_transport, cas_transport, ("en", "fr")[i % 2], results)
+
+    async with webapp.lifespan(app):
+        start = perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = perf_counter() - start
+    await webapp.cas_client.close()
+
+    print(f"fake CAS: latency={cas_latency}s (+{cas_jitter}s jitter), failure rate={cas_failure_rate}, calls={fake_cas.stats}")
+    print(f"CAS validation mode: {webapp.cas_client.validation_mode}, concurrency: {concurrency}")
+    results.report(duration, users)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test of the CAS login flow")
+    parser.add_argument("--users", type=int, default=500, help="number of login flows")
+    parser.add_argument("--concurrency", type=int, default=50, help="simultaneous users")
+    parser.add_argument("--cas-latency", type=float, default=0.02, help="seconds added by the fake CAS to each validation call")
+    parser.add_argument("--cas-jitter", type=float, default=0.01, help="up to this many random seconds added to the CAS latency")
+    parser.add_argument("--cas-failure-rate", type=float, default=0, help="probability of a 500 on CAS validation calls")
+    parser.add_argument("--verbose", action="store_true", help="show the app logs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if not args.verbose:
+        logging.getLogger("cas").setLevel(logging.WARNING)
+    asyncio.run(main(args.users, args.concurrency, args.cas_latency, args.cas_jitter, args.cas_failure_rate))
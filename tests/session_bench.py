@@ -0,0 +1,85 @@
+# Benchmark of the session middlewares (src/sessions.py): Starlette's signed cookie SessionMiddleware (JSON),
+# CompactSessionMiddleware (msgpack) and ServerSessionMiddleware with the in-memory and SQLite backends, for a logged in user
+# (CAS user, Discord tokens, username, ID and guilds): per request overhead and cookie bytes on the wire,
+# for a page and a static file. The ASGI apps are called directly, without an HTTP client in between.
+#
+# Usage: python tests/session_bench.py [number_of_requests]
+
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import asyncio
+import secrets
+import sys
+
+sys.path.insert(0, path.join(path.dirname(__file__), "../src"))
+
+from starlette.middleware.sessions import SessionMiddleware
+
+from sessions import CompactSessionMiddleware, MemorySessionBackend, SQLiteSessionBackend, ServerSessionMiddleware
+
+SESSION = {
+    "lang": "fr",
+    "user": [2712847316, "jdoe", "John Doe", "jdoe@ulb.be", "000123456", ["[role={SUPANN}E10][type={SUPANN}S230][code=ULB-POLYTECH]"]],
+    "sid": secrets.token_urlsafe(16),
+    "discord_token": secrets.token_urlsafe(22),
+    "discord_refresh_token": secrets.token_urlsafe(22),
+    "discord_token_expires_at": 1790000000.123456,
+    "discord_username": "nelly",
+    "discord_global_name": "Nelly",
+    "discord_id": "80351110224678912",
+    "discord_guilds": [1000000000000000000 + i for i in range(5)],
+}
+
+
+async def endpoint(scope, receive, send):
+    if "session" in scope:
+        scope["session"].get("user") # read like the pages do
+        if scope["path"] == "/login":
+            scope["session"].update(SESSION)
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def request(app, path: str, cookie: bytes = b"") -> list:
+    scope = {"type": "http", "method": "GET", "path": path, "headers": [(b"cookie", cookie)] if cookie else [], "query_string": b""}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return dict(messages[0]["headers"]).get(b"set-cookie", b"")
+
+
+async def bench(name: str, app, number: int):
+    set_cookie = await request(app, "/login")
+    cookie = set_cookie.split(b";")[0]
+    results = []
+    for page in ("/fr/user", "/static/style.css"):
+        start = perf_counter()
+        for _ in range(number):
+            response_cookie = await request(app, page, cookie)
+        duration = (perf_counter() - start) / number * 1e6
+        results.append(f"{page:<18} {duration:>9.1f} us {len(cookie):>8} B {len(response_cookie):>8} B")
+    for line in results:
+        print(f"{name:<10} {line}")
+
+
+async def main(number: int = 20000):
+    print(f"{number} requests per page, session of {len(SESSION)} keys")
+    print(f"{'backend':<10} {'page':<18} {'per request':>12} {'cookie':>10} {'set-cookie':>10}")
+    await bench("cookie", SessionMiddleware(endpoint, secret_key="bench", same_site="strict"), number)
+    await bench("compact", CompactSessionMiddleware(endpoint, secret_key="bench", same_site="strict"), number)
+    await bench("memory", ServerSessionMiddleware(endpoint, MemorySessionBackend(), same_site="strict"), number)
+    with TemporaryDirectory() as tmp:
+        backend = SQLiteSessionBackend(path.join(tmp, "sessions.db"))
+        await bench("sqlite", ServerSessionMiddleware(endpoint, backend, same_site="strict"), number // 10 or 1)
+        await backend.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:2])))
@@ -0,0 +1,90 @@
+# CASResponseParser over the recorded CAS responses of fixtures/cas/
+
+import pytest
+
+from cas_auth import CASResponseParser, CasParseError, CasRejectError
+from conftest import read_fixture
+
+
+def test_v3_success_keeps_all_attributes_without_filter():
+    user, attributes, pgtiou = CASResponseParser().parse(read_fixture("cas/v3_success.xml"))
+    assert user == "jdoe"
+    assert pgtiou is None
+    assert attributes["mail"] == "John.Doe@ULB.be"
+    assert attributes["cn"] == "John Doe"
+    assert attributes["eduPersonAffiliation"] == ["student", "member"] # repeated elements => list
+    assert len(attributes["supannRoleEntite"]) == 2
+
+
+def test_v3_success_filtered():
+    user, attributes, _ = CASResponseParser(["mail", "givenName", "notSent"]).parse(read_fixture("cas/v3_success.xml"))
+    assert user == "jdoe"
+    assert attributes == {"mail": "John.Doe@ULB.be", "givenName": "John"}
+
+
+def test_v2_success_with_pgtiou():
+    user, attributes, pgtiou = CASResponseParser().parse(read_fixture("cas/v2_success.xml"))
+    assert (user, attributes, pgtiou) == ("jdoe", {}, "PGTIOU-84678-8a9d2sfa23casd")
+
+
+@pytest.mark.parametrize("fixture", ["cas/v2_failure.xml", "cas/v3_failure.xml"])
+def test_failure_raises_reject(fixture):
+    with pytest.raises(CasRejectError) as error:
+        CASResponseParser().parse(read_fixture(fixture))
+    assert error.value.args[0] == "INVALID_TICKET"
+    assert "not recognized" in error.value.args[1]
+
+
+def test_attributes_directly_under_success():
+    content = (
+        b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas"><cas:authenticationSuccess>'
+        b'<cas:user>jdoe</cas:user><cas:mail>jdoe@ulb.be</cas:mail>'
+        b'</cas:authenticationSuccess></cas:serviceResponse>'
+    )
+    assert CASResponseParser(["mail"]).parse(content) == ("jdoe", {"mail": "jdoe@ulb.be"}, None)
+
+
+@pytest.mark.parametrize("content", [
+    b"not xml",
+    b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas"/>',
+    b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas"><cas:authenticationSuccess/></cas:serviceResponse>', # no user
+])
+def test_unexpected_responses_raise_parse_error(content):
+    with pytest.raises(CasParseError):
+        CASResponseParser().parse(content)
+
+
+def test_entities_are_not_resolved():
+    content = (
+        b'<?xml version="1.0"?><!DOCTYPE r [<!ENTITY e SYSTEM "file:///etc/passwd">]>'
+        b'<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas"><cas:authenticationSuccess>'
+        b'<cas:user>&e;</cas:user></cas:authenticationSuccess></cas:serviceResponse>'
+    )
+    try:
+        user, _, _ = CASResponseParser().parse(content)
+    except CasParseError:
+        return
+    assert "root:" not in (user or "")
+
+
+def test_v1():
+    parser = CASResponseParser()
+    assert parser.parse_v1(read_fixture("cas/v1_success.txt")) == ("jdoe", {}, None)
+    with pytest.raises(CasRejectError):
+        parser.parse_v1(read_fixture("cas/v1_failure.txt"))
+
+
+def test_proxy_ticket():
+    parser = CASResponseParser()
+    assert parser.parse_proxy(read_fixture("cas/proxy_success.xml")) == "PT-1856392-b98xZrQN4p90ASrw96c8"
+    assert parser.parse_proxy(read_fixture("cas/v2_failure.xml")) is None
+
+
+def test_logout_request_session_index():
+    content = (
+        b'<samlp:LogoutRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        b'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="1" Version="2.0" IssueInstant="2024-09-16T08:12:44Z">'
+        b'<saml:NameID>@NOT_USED@</saml:NameID><samlp:SessionIndex>ST-1-abc</samlp:SessionIndex>'
+        b'</samlp:LogoutRequest>'
+    )
+    assert CASResponseParser().parse_logout_request(content) == "ST-1-abc"
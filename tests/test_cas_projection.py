@@ -0,0 +1,47 @@
+# AttributeProjection: normalizers, CASUser packing and sessions packed with another filter
+
+from cas_auth import AttributeProjection, CASResponseParser
+from conftest import read_fixture
+
+FILTER = ["cn", "mail", "supannRefId", "supannRoleEntite"]
+
+
+def test_apply_normalizes():
+    _, attributes, _ = CASResponseParser(FILTER).parse(read_fixture("cas/v3_success.xml"))
+    user = AttributeProjection(FILTER).apply("jdoe", attributes)
+    assert user.user == "jdoe"
+    assert user["mail"] == "john.doe@ulb.be"
+    assert len(user["supannRoleEntite"]) == 2
+    assert user.get("missing", "default") == "default"
+
+
+def test_empty_elements():
+    projection = AttributeProjection(["mail", "eduPersonAffiliation"])
+    user = projection.apply("jdoe", {"mail": [None, " JDoe@ULB.be "], "eduPersonAffiliation": [None, "student"]})
+    assert user["mail"] == "jdoe@ulb.be"
+    assert user["eduPersonAffiliation"] == ["student"]
+    assert projection.apply("jdoe", {"mail": [None, None]}).get("mail") is None
+    assert projection.apply("jdoe", {"mail": ""}).get("mail") is None
+
+
+def test_pack_round_trip():
+    projection = AttributeProjection(FILTER)
+    user = projection.apply("jdoe", {"cn": "John Doe", "mail": "jdoe@ulb.be"})
+    unpacked = projection.unpack(user.pack())
+    assert unpacked.user == "jdoe"
+    assert unpacked.as_dict() == user.as_dict()
+
+
+def test_sessions_packed_with_another_filter_are_dropped():
+    packed = AttributeProjection(["cn", "mail"]).apply("jdoe", {"cn": "John Doe", "mail": "jdoe@ulb.be"}).pack()
+    assert AttributeProjection(["mail", "cn"]).unpack(packed) is None # reordered
+    assert AttributeProjection(["mail"]).unpack(packed) is None # removed
+    assert AttributeProjection(["cn", "mail", "sn"]).unpack(packed) is None # added
+    assert AttributeProjection(["cn", "mail"]).unpack(["jdoe", "John Doe", "jdoe@ulb.be"]) is None # unversioned
+
+
+def test_unpack_legacy_and_empty():
+    projection = AttributeProjection(FILTER)
+    assert projection.unpack(None) is None
+    legacy = projection.unpack({"user": "jdoe"})
+    assert legacy.user == "jdoe" and legacy.get("mail") is None
@@ -0,0 +1,75 @@
+# CASAuth.validate() against tests/fake_cas_server.py: single-flight of concurrent callbacks, single-use tickets
+
+import asyncio
+
+import pytest
+from httpx import ASGITransport
+
+from cas_auth import CASAuth, CasRequestError, CasUnavailableError, CircuitBreaker
+from fake_cas_server import FakeCASServer
+
+pytestmark = pytest.mark.anyio
+
+SERVICE_URL = "http://localhost:8000/login"
+
+
+@pytest.fixture
+async def cas():
+    server = FakeCASServer(latency=0.05)
+    client = CASAuth("http://fake-cas.test", SERVICE_URL, version=3)
+    await client.init(transport=ASGITransport(app=server.app))
+    yield server, client
+    await client.close()
+
+
+async def test_concurrent_callbacks_share_one_validation(cas):
+    server, client = cas
+    ticket = server.issue_ticket("jdoe", SERVICE_URL)
+    results = await asyncio.gather(*(client.validate(ticket) for _ in range(5)))
+    assert all(user == "jdoe" for user, _ in results)
+    assert server.stats["validate"] == 1
+    assert client._inflight == {}
+
+
+async def test_ticket_not_reused_after_validation(cas):
+    server, client = cas
+    ticket = server.issue_ticket("jdoe", SERVICE_URL)
+    user, attributes = await client.validate(ticket)
+    assert user == "jdoe" and attributes["mail"] == "jdoe@ulb.be"
+    # a later request with the same ticket (e.g. after a Single Logout) goes to CAS, which rejects it
+    user, attributes = await client.validate(ticket)
+    assert (user, attributes) == (None, {})
+    assert server.stats["validate"] == 2
+
+
+async def test_errors_are_shared_then_forgotten(cas):
+    server, client = cas
+    server.failure_rate = 1
+    ticket = server.issue_ticket("jdoe", SERVICE_URL)
+    results = await asyncio.gather(*(client.validate(ticket) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, CasRequestError) for result in results)
+    assert server.stats["validate"] == 1
+    server.failure_rate = 0
+    assert (await client.validate(ticket))[0] == "jdoe"
+
+
+async def test_cancelled_caller_does_not_cancel_shared_validation(cas):
+    server, client = cas
+    ticket = server.issue_ticket("jdoe", SERVICE_URL)
+    first = asyncio.ensure_future(client.validate(ticket))
+    await asyncio.sleep(0.01)
+    second = asyncio.ensure_future(client.validate(ticket))
+    await asyncio.sleep(0.01)
+    first.cancel() # client disconnected
+    user, _ = await second
+    assert user == "jdoe"
+    assert server.stats["validate"] == 1
+
+
+async def test_open_breaker_refuses_without_calling_cas(cas):
+    server, client = cas
+    client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    client.breaker.record_failure()
+    with pytest.raises(CasUnavailableError):
+        await client.validate(server.issue_ticket("jdoe", SERVICE_URL))
+    assert server.stats["validate"] == 0
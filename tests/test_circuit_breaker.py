@@ -0,0 +1,74 @@
+# CircuitBreaker state transitions: closed -> open -> half-open -> closed/open
+
+import pytest
+
+import cas_auth
+from cas_auth import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cas_auth, "monotonic", clock)
+    return clock
+
+
+def test_opens_after_threshold_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() == 30
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_allows_one_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.state == "open" and breaker.retry_after() == 20
+    clock.now += 20
+    assert breaker.state == "half-open"
+    assert breaker.allow() # the trial call
+    assert not breaker.allow() # the others wait for its outcome
+
+
+def test_successful_trial_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_trial_opens_again(clock):
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure() # a single failure of the trial is enough
+    assert breaker.state == "open"
+    assert breaker.retry_after() == 30
+    clock.now += 30
+    assert breaker.allow()
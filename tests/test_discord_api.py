@@ -0,0 +1,41 @@
+# DiscordAPI error responses (src/discord_api.py), against an httpx.MockTransport
+
+import httpx
+import pytest
+from fastapi_discord import DiscordOAuthClient, RateLimited
+from fastapi_discord.exceptions import InvalidRequest, InvalidToken
+
+from discord_api import DiscordAPI
+
+pytestmark = pytest.mark.anyio
+
+
+async def discord_api(status: int, content: bytes = b"", headers: dict = None) -> DiscordAPI:
+    api = DiscordAPI(DiscordOAuthClient("1", "secret", "http://localhost:8000/discord-callback"), http2=False)
+    await api.init(transport=httpx.MockTransport(lambda request: httpx.Response(status, content=content, headers=headers)))
+    return api
+
+
+async def test_html_429_is_rate_limited():
+    api = await discord_api(429, b"<html>Cloudflare</html>", {"Retry-After": "30", "Content-Type": "text/html"})
+    with pytest.raises(RateLimited) as e:
+        await api.request("/users/@me", "token")
+    assert e.value.retry_after == 30
+    with pytest.raises(RateLimited):
+        await api.refresh_access_token("refresh")
+    await api.close()
+
+
+async def test_revoked_refresh_token():
+    api = await discord_api(400, b'{"error": "invalid_grant"}', {"Content-Type": "application/json"})
+    with pytest.raises(InvalidToken):
+        await api.refresh_access_token("refresh")
+    await api.close()
+
+
+@pytest.mark.parametrize("status, content", [(401, b'{"error": "invalid_client"}'), (502, b"Bad Gateway"), (200, b"not JSON")])
+async def test_token_errors(status, content):
+    api = await discord_api(status, content)
+    with pytest.raises(InvalidRequest):
+        await api.get_access_token("code")
+    await api.close()
@@ -0,0 +1,25 @@
+# Index of the bot's guild IDs (src/guild_index.py)
+
+from guild_index import GuildIndex
+
+
+def test_intersect():
+    index = GuildIndex([1, 2, 3])
+    assert index.loaded
+    assert sorted(index.intersect(["2", "3", "4"])) == [2, 3] # Discord API IDs are strings
+
+
+def test_never_loaded_index_knows_no_shared_guilds():
+    index = GuildIndex()
+    index.add(1) # a guild joined before the bot is ready
+    assert not index.loaded
+    assert index.intersect(["1", "2"]) is None # unknown, not "no shared guild"
+
+
+def test_load_empty():
+    index = GuildIndex()
+    index.load([])
+    assert index.loaded and index.intersect(["1"]) == []
+    index.add("5")
+    index.discard(6)
+    assert index.intersect([5, 6]) == [5]
@@ -0,0 +1,46 @@
+# Locale.negotiate() and lang_str(), over the locales/*.json files (en, fr)
+
+import pytest
+
+from locales import DEFAULT_LANG, Locale
+
+
+@pytest.fixture
+def locale():
+    return Locale(negotiation_cache_size=4)
+
+
+@pytest.mark.parametrize("header, lang", [
+    ("fr", "fr"),
+    ("FR", "fr"),
+    ("fr-BE,fr;q=0.9,en;q=0.8", "fr"),
+    ("fr-BE", "fr"), # region falls back to its language
+    ("de-DE,de;q=0.9,fr;q=0.7,en;q=0.8", "en"), # by q-value, not header order
+    ("en;q=0.5,fr;q=0.5", "en"), # same q-value: header order
+    (" fr ; q=0.9 , en ; q=0.8 ", "fr"),
+    ("fr;q=0,en", "en"), # q=0 means not acceptable
+    ("fr;q=abc,en;q=0.1", "en"), # invalid q-value, ignored
+    ("de,nl", None),
+    ("*", None),
+    ("", None),
+    (None, None),
+])
+def test_negotiate(locale, header, lang):
+    assert locale.negotiate(header) == lang
+
+
+def test_negotiate_memoized_and_bounded(locale):
+    assert locale.negotiate("fr-BE,fr;q=0.9") == "fr"
+    assert locale.negotiate("fr-BE,fr;q=0.9") == "fr"
+    assert locale.negotiation_stats == {"hits": 1, "misses": 1}
+    for i in range(10):
+        locale.negotiate(f"de;q=0.{i},en")
+    assert len(locale._negotiated) <= locale.negotiation_cache_size
+
+
+def test_lang_str_falls_back_to_default_language(locale):
+    key = next(iter(locale.languages[DEFAULT_LANG]))
+    assert locale.lang_str(key, "zz") == locale.lang_str(key, DEFAULT_LANG) # unsupported language
+    assert locale.lang_str("no such key", "fr") == "no such key"
+    for lang in locale.lang_list:
+        assert set(locale.catalogs[lang]) >= set(locale.languages[DEFAULT_LANG])
@@ -0,0 +1,135 @@
+# DiscordRateLimiter: probes of unknown buckets, update()/cancel(), max_wait and idle bucket removal
+
+import asyncio
+from time import monotonic
+
+import pytest
+
+from ratelimit import DiscordRateLimiter, RateLimitTimeout
+
+pytestmark = pytest.mark.anyio
+
+ROUTE = "PATCH /guilds/{guild_id}/members/{user_id}"
+HEADERS = {"X-RateLimit-Bucket": "abc", "X-RateLimit-Remaining": "4", "X-RateLimit-Reset-After": "1"}
+
+
+async def test_unknown_bucket_sends_one_probe():
+    limiter = DiscordRateLimiter(probe_timeout=5)
+    await limiter.acquire(ROUTE, 1) # the probe
+    second = asyncio.ensure_future(limiter.acquire(ROUTE, 1))
+    await asyncio.sleep(0.05)
+    assert not second.done() # waits for the probe's response
+    limiter.update(ROUTE, 1, HEADERS)
+    await asyncio.wait_for(second, 1)
+
+
+async def test_update_without_headers_ends_probe():
+    limiter = DiscordRateLimiter(probe_timeout=5)
+    start = monotonic()
+    for _ in range(3):
+        await limiter.acquire(ROUTE, 1)
+        limiter.update(ROUTE, 1, {}) # a route answering without rate limit headers
+    assert monotonic() - start < 0.5
+
+
+async def test_success_without_information_keeps_known_limits():
+    limiter = DiscordRateLimiter(probe_timeout=5)
+    await limiter.acquire(ROUTE, 1)
+    limiter.update(ROUTE, 1, {**HEADERS, "X-RateLimit-Remaining": "1", "X-RateLimit-Reset-After": "0.2"})
+    await limiter.acquire(ROUTE, 1)
+    limiter.cancel(ROUTE, 1) # the bot's successful edits, disnake doesn't expose their headers
+    with pytest.raises(RateLimitTimeout): # still limited: the bucket is exhausted until its reset
+        await limiter.acquire(ROUTE, 1, max_wait=0.1)
+    await asyncio.sleep(0.2)
+    await limiter.acquire(ROUTE, 1) # after the reset, a probe again (the route isn't considered unlimited)
+    second = asyncio.ensure_future(limiter.acquire(ROUTE, 1))
+    await asyncio.sleep(0.05)
+    assert not second.done()
+    limiter.cancel(ROUTE, 1)
+    await asyncio.wait_for(second, 1)
+
+
+async def test_cancel_ends_probe():
+    limiter = DiscordRateLimiter(probe_timeout=5)
+    await limiter.acquire(ROUTE, 1)
+    second = asyncio.ensure_future(limiter.acquire(ROUTE, 1))
+    await asyncio.sleep(0.05)
+    limiter.cancel(ROUTE, 1) # the probe got no response
+    await asyncio.wait_for(second, 1)
+
+
+async def test_probe_timeout():
+    limiter = DiscordRateLimiter(probe_timeout=0.1)
+    await limiter.acquire(ROUTE, 1) # never answered
+    await asyncio.wait_for(limiter.acquire(ROUTE, 1, max_wait=None), 1)
+
+
+async def test_probe_wait_bounded_by_max_wait():
+    limiter = DiscordRateLimiter(probe_timeout=10)
+    await limiter.acquire(ROUTE, 1)
+    start = monotonic()
+    with pytest.raises(RateLimitTimeout):
+        await limiter.acquire(ROUTE, 1, max_wait=0.1)
+    assert monotonic() - start < 1
+
+
+async def test_lock_wait_bounded_by_max_wait():
+    limiter = DiscordRateLimiter(probe_timeout=10)
+    await limiter.acquire(ROUTE, 1)
+    waiting = asyncio.ensure_future(limiter.acquire(ROUTE, 1, max_wait=None)) # holds the bucket lock, waiting for the probe
+    await asyncio.sleep(0.05)
+    with pytest.raises(RateLimitTimeout):
+        await limiter.acquire(ROUTE, 1, max_wait=0.1)
+    limiter.cancel(ROUTE, 1)
+    await asyncio.wait_for(waiting, 1)
+
+
+async def test_timed_out_probe_is_released():
+    limiter = DiscordRateLimiter(global_rate=1, probe_timeout=10)
+    await limiter.acquire("GET /other", None) # fills the global budget for 1s
+    with pytest.raises(RateLimitTimeout):
+        await limiter.acquire(ROUTE, 1, max_wait=0.1) # became the probe of ROUTE, but wasn't sent
+    start = monotonic()
+    await limiter.acquire(ROUTE, 1, max_wait=None) # doesn't wait for a probe that will never be answered
+    assert monotonic() - start < 2
+
+
+async def test_exhausted_bucket_delays_or_times_out():
+    limiter = DiscordRateLimiter()
+    await limiter.acquire(ROUTE, 1)
+    limiter.update(ROUTE, 1, {**HEADERS, "X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "0.2"})
+    with pytest.raises(RateLimitTimeout):
+        await limiter.acquire(ROUTE, 1, max_wait=0.05)
+    start = monotonic()
+    await limiter.acquire(ROUTE, 1, max_wait=1)
+    assert 0.1 < monotonic() - start < 0.5
+
+
+async def test_429_blocks_bucket():
+    limiter = DiscordRateLimiter()
+    await limiter.acquire(ROUTE, 1)
+    retry_after = limiter.update(ROUTE, 1, {"Retry-After": "0.2"}, 429, {"retry_after": 0.2})
+    assert retry_after == 0.2
+    assert limiter.stats["rate_limited"] == 1
+    with pytest.raises(RateLimitTimeout):
+        await limiter.acquire(ROUTE, 1, max_wait=0.05)
+
+
+async def test_idle_buckets_are_removed():
+    limiter = DiscordRateLimiter(sweep_interval=0)
+    for token in range(100):
+        await limiter.acquire("GET /users/@me", token)
+        limiter.update("GET /users/@me", token, {"X-RateLimit-Remaining": "4", "X-RateLimit-Reset-After": "0.05"})
+    await asyncio.sleep(0.1)
+    await limiter.acquire("GET /users/@me", "new")
+    assert len(limiter._buckets) == 1
+    assert limiter.stats["buckets"] == 1
+
+
+async def test_buckets_in_use_are_kept():
+    limiter = DiscordRateLimiter(sweep_interval=0)
+    await limiter.acquire(ROUTE, 1) # probe in flight
+    await limiter.acquire(ROUTE, 2)
+    limiter.update(ROUTE, 2, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "10"})
+    await limiter.acquire("GET /other", None)
+    assert {major for _, major in limiter._buckets} >= {1, 2}
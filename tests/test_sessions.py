@@ -0,0 +1,142 @@
+# Session codec and middlewares (src/sessions.py), called as plain ASGI apps
+
+import json
+import secrets
+from base64 import b64encode
+
+import itsdangerous
+import pytest
+
+from sessions import CompactSessionMiddleware, MemorySessionBackend, ServerSessionMiddleware, SessionCodec, regenerate_session_id
+
+pytestmark = pytest.mark.anyio
+
+SESSION = {
+    "user": [790531289, "jdoe", "John Doe", "jdoe@ulb.be"],
+    "sid": secrets.token_urlsafe(16),
+    "discord_token": secrets.token_urlsafe(22),
+    "discord_token_expires_at": 1790000000.0,
+    "discord_id": "80351110224678912",
+    "discord_guilds": [1000000000000000000 + i for i in range(5)],
+}
+
+
+def test_codec_round_trip():
+    codec = SessionCodec()
+    session = {**SESSION, "unknown": {"a": [1, "b"]}, "discord_username": None}
+    assert codec.decode(codec.encode(session)) == session
+
+
+@pytest.mark.parametrize("user", [{"user": "jdoe", "mail": "jdoe@ulb.be"}, "jdoe", (790531289, "jdoe")])
+def test_codec_keeps_legacy_users(user):
+    codec = SessionCodec()
+    assert codec.decode(codec.encode({"user": user})) == {"user": list(user) if isinstance(user, tuple) else user}
+
+
+def test_codec_is_compact():
+    codec = SessionCodec()
+    assert len(codec.encode(SESSION)) < len(json.dumps(SESSION)) * 0.75
+    encoded = codec.encode_fields(SESSION)
+    assert isinstance(encoded["i"], int) # Discord ID as an integer
+    assert isinstance(encoded["s"], bytes) and len(encoded["s"]) == 16 # token as its raw bytes
+
+
+@pytest.mark.parametrize("sid", ["not a token!", "abc", "0123"])
+def test_codec_keeps_non_token_values(sid):
+    codec = SessionCodec()
+    assert codec.decode(codec.encode({"sid": sid, "discord_id": "me"})) == {"sid": sid, "discord_id": "me"}
+
+
+def test_codec_rejects_other_data():
+    with pytest.raises(ValueError):
+        SessionCodec().decode(b"\x93\x01\x02\x03") # a msgpack list
+
+
+async def call(app, cookie: str = "", update=None, path: str = "/"):
+    """ Calls a session middleware around an endpoint applying `update(scope)`, returns (session seen, Set-Cookie headers) """
+    seen = {}
+
+    async def endpoint(scope, receive, send):
+        seen.update(scope.get("session", {}))
+        if update is not None:
+            update(scope)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    headers = [(b"cookie", f"session={cookie}".encode())] if cookie else []
+    await app(endpoint)({"type": "http", "method": "GET", "path": path, "headers": headers, "query_string": b""}, receive, send)
+    set_cookies = [value.decode() for name, value in messages[0]["headers"] if name == b"set-cookie"]
+    return seen, set_cookies
+
+
+def cookie_value(set_cookie: str) -> str:
+    return set_cookie.split(";", 1)[0].split("=", 1)[1]
+
+
+async def test_compact_cookie_round_trip():
+    app = lambda endpoint: CompactSessionMiddleware(endpoint, secret_key="test")
+    _, set_cookies = await call(app, update=lambda scope: scope["session"].update(SESSION))
+    seen, _ = await call(app, cookie_value(set_cookies[0]))
+    assert seen == SESSION
+
+
+async def test_compact_reads_starlette_cookies():
+    signed = itsdangerous.TimestampSigner("test").sign(b64encode(json.dumps({"user": "jdoe"}).encode())).decode()
+    seen, _ = await call(lambda endpoint: CompactSessionMiddleware(endpoint, secret_key="test"), signed)
+    assert seen == {"user": "jdoe"}
+
+
+async def test_compact_budget_sheds_guilds_first():
+    session = {**SESSION, "discord_guilds": [1000000000000000000 + i for i in range(200)]}
+    app = lambda endpoint: CompactSessionMiddleware(endpoint, secret_key="test", max_bytes=1000)
+    _, set_cookies = await call(app, update=lambda scope: scope["session"].update(session))
+    assert len(cookie_value(set_cookies[0])) <= 1000
+    seen, _ = await call(app, cookie_value(set_cookies[0]))
+    assert "discord_guilds" not in seen
+    assert seen["discord_token"] == SESSION["discord_token"]
+
+
+async def test_compact_budget_not_saved_when_still_too_big():
+    app = lambda endpoint: CompactSessionMiddleware(endpoint, secret_key="test", max_bytes=100)
+    _, set_cookies = await call(app, update=lambda scope: scope["session"].update(SESSION))
+    assert set_cookies == []
+
+
+async def test_server_sessions_store_nothing_for_empty_sessions():
+    backend = MemorySessionBackend()
+    app = lambda endpoint: ServerSessionMiddleware(endpoint, backend)
+    for _ in range(10):
+        _, set_cookies = await call(app, update=lambda scope: scope["session"].get("user"))
+        assert set_cookies == []
+    assert len(backend) == 0
+
+
+async def test_server_sessions_round_trip_regenerate_and_clear():
+    backend = MemorySessionBackend()
+    app = lambda endpoint: ServerSessionMiddleware(endpoint, backend)
+    _, set_cookies = await call(app, update=lambda scope: scope["session"].update({"user": "jdoe"}))
+    store_id = cookie_value(set_cookies[0])
+    seen, set_cookies = await call(app, store_id)
+    assert seen == {"user": "jdoe"} and set_cookies == [] # unchanged, not written back
+
+    _, set_cookies = await call(app, store_id, update=regenerate_session_id) # login, against session fixation
+    new_store_id = cookie_value(set_cookies[0])
+    assert new_store_id != store_id and len(backend) == 1
+    assert (await call(app, store_id))[0] == {}
+
+    _, set_cookies = await call(app, new_store_id, update=lambda scope: scope["session"].clear())
+    assert cookie_value(set_cookies[0]) == "null" and len(backend) == 0
+
+
+async def test_server_sessions_excluded_paths():
+    backend = MemorySessionBackend()
+    seen, set_cookies = await call(lambda endpoint: ServerSessionMiddleware(endpoint, backend), path="/static/style.css")
+    assert seen == {} and set_cookies == []